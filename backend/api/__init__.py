@@ -38,13 +38,43 @@ environment variables that are currently used:
 | `SQL_ECHO` | not defined | Whether to echo SQL statements to the console for debugging purposes. |
 | `DISABLE_AUTH` | not defined | Whether to disable authentication. When running with authentication disabled, the user is assumed to be logged as the user with `id=1`, which must exist in the database. |
 | `ACCESS_TOKEN_MINUTES` | `15` | The number of minutes an access token is valid for. |
+| `PASSWORD_HASH_METHOD` | `scrypt:32768:8:1` | The werkzeug method and parameters used to hash passwords, e.g. `pbkdf2:sha256:600000`. Hashes made with another method are upgraded when their user logs in. |
+| `PASSWORD_HASH_WORKERS` | `2` | With threaded workers, such as gunicorn's `gthread` class, the number of requests per worker that may hash or check a password at once, the others waiting their turn. This bounds the CPU taken by a burst of logins. The sync workers started by `boot.sh` handle one request at a time, so it has no effect there. Set to `0` for no limit. |
+| `STATELESS_ACCESS_TOKENS` | not defined | Whether access tokens carry the user id, role and expiration, so that requests are authenticated without a query on the tokens table, the user being loaded by its id. Revoked access tokens are then deny-listed in redis until they expire. Without `USE_CACHE`, or while redis is unavailable, tokens are checked against the database. |
 | `REFRESH_TOKEN_DAYS` | `7` | The number of days a refresh token is valid for. |
 | `REFRESH_TOKEN_IN_COOKIE` | `yes` | Whether to return the refresh token in a secure cookie. |
 | `REFRESH_TOKEN_IN_BODY` | `no` | Whether to return the refresh token in the response body. |
 | `RESET_TOKEN_MINUTES` | `15` | The number of minutes a reset token is valid for. |
 | `PASSWORD_RESET_URL` | `http://localhost:3000/reset` | The URL that will be used in password reset links. |
 | `USE_CORS` | `yes` | Whether to allow cross-origin requests. If allowed, CORS support can be configured or customized with options provided by the Flask-CORS extension. |
-| `USE_CACHE` | `yes` | Whether to allow caching of api responses using redis. |
+| `PRODUCT_EXPIRY_INTERVAL` | `300` | The number of seconds between two runs of the background task that flags the products past their deadline as expired. Set to `0` to disable it, and run `flask tasks run expire_products` from a scheduler instead. |
+| `TOKEN_CLEAN_INTERVAL` | `3600` | The number of seconds between two runs of the background task that removes the tokens expired for more than a day. Set to `0` to disable it, and run `flask tasks run clean_tokens` from a scheduler instead. |
+| `ACTIVITY_FLUSH_INTERVAL` | `60` | The number of seconds between two writes of the users' last seen times. Each worker buffers the times of the requests it authenticates in memory, and saves them in a single batched update. |
+| `REDIS_URI` | not defined | The redis server holding the rate limit counters, e.g. `redis://redis:6379`. Counters are kept in the memory of each worker when not defined, or while redis is unreachable. |
+| `RATELIMIT_STRATEGY` | `local-token-bucket` | The rate limiting strategy. `local-token-bucket` counts fixed windows in redis but lets each worker grant a share of the requests left in a window on its own, see `RATELIMIT_LOCAL_SHARE`. The Flask-Limiter strategies such as `fixed-window` can be used instead. |
+| `RATELIMIT_LOCAL_SHARE` | `0.1` | The fraction of the requests left in a window that a worker grants before counting them in redis. |
+| `RATELIMIT_SYNC_INTERVAL` | `1` | The maximum number of seconds a worker grants requests before counting them in redis. |
+| `RATELIMIT_DEFAULT` | `1000 per hour` | The limit of the routes that have no budget below, per user or per client address for anonymous requests. |
+| `RATELIMIT_CATALOG` | `120 per minute` | The budget of anonymous clients for each read route of the catalog: products, artists and carts. Authenticated users get `RATELIMIT_CATALOG_USER`, by default `300 per minute`, and admins `1000 per minute`. |
+| `RATELIMIT_WRITES` | `10 per minute` | The budget of anonymous clients for each write route of the catalog. Authenticated users get `RATELIMIT_WRITES_USER`, by default `60 per minute`, and admins `600 per minute`. |
+| `UNIQUE_PRECHECK` | `yes` | Whether to check the unique fields of a payload, such as usernames and emails, with one query before writing it. Otherwise values already taken are reported from the database's unique constraints, with the same field errors, and only the fields without a unique constraint, such as emails, are still checked first. |
+| `UNIQUE_BLOOM_FILTER` | not defined | Whether to keep the usernames in a Bloom filter in each worker, so that usernames never seen before are known to be available without a query. |
+| `UNIQUE_BLOOM_TTL` | `300` | The number of seconds after which a worker reloads its Bloom filter from the database. |
+| `BULK_CHUNK_SIZE` | `1000` | The number of rows updated or deleted per statement, and per transaction, by the bulk admin actions such as expiring or deleting all the products. |
+| `RAISE_ON_LAZY_LOAD` | not defined | Whether building a paginated response fails when it lazy loads a relationship missing from the endpoint's loader profile. Meant for tests and development. |
+| `USE_CACHE` | `yes` | Whether to allow caching of api responses using redis. Cached data is invalidated with `flask cache flush [NAMESPACE]...`, which moves the namespace to a new generation of keys and lets the old ones expire. `render.sh` runs it once per deploy; other deployments should also run it once per release, rather than when each container boots. |
+| `CACHE_LOCAL_SIZE` | `0` | The number of cached responses each worker also keeps in memory in front of redis. Set to `0` to disable the in-process cache. |
+| `CACHE_LOCAL_TTL` | `5` | The number of seconds a response is served from a worker's memory before it is read again from redis. |
+| `CACHE_LOCK_TIMEOUT` | `10` | The number of seconds a worker may hold the lock used to rebuild an expired cached response before it is released automatically. |
+| `CACHE_LOCK_WAIT` | `2` | The number of seconds other workers wait for that response to be rebuilt before querying the database themselves. |
+| `CACHE_COMPRESS_MIN_SIZE` | `0` | The size in bytes above which cached data is stored compressed in redis. Cached responses are gzipped and sent gzipped to clients that accept it. Set to `0` to disable compression. |
+| `CACHE_METRICS_INTERVAL` | `10` | The number of seconds between two writes of a worker's cache metrics to redis. The metrics are available to admins at `/api/admin/cache/metrics`. |
+| `CACHE_METRICS_SAMPLE_RATE` | `0.01` | The fraction of cache calls logged with their key in the cache metrics. |
+| `CACHE_METRICS_SAMPLES` | `100` | The maximum number of sampled cache calls kept. |
+| `CACHE_CODEC` | `json` | The codec used to store cached values other than responses. Allowed values are `json` and `msgpack`. Run `flask cache bench` to compare them on your data. |
+| `CACHE_COMPRESSION` | `gzip` | The compression applied to cached values other than responses above `CACHE_COMPRESS_MIN_SIZE`. Allowed values are `gzip`, the compression of cached responses, and `zstd`, which requires the `zstandard` package. |
+| `TOKEN_CACHE_SIZE` | `1000` | The number of verified access tokens each worker remembers, so that authenticating a request needs no query on the tokens table, the user being loaded by its id. Revoked tokens are broadcast to all workers over redis. Only used when `USE_CACHE` is enabled, set to `0` to verify every request against the database. |
+| `TOKEN_CACHE_TTL` | `300` | The maximum number of seconds a worker trusts a token it verified, which bounds how long a missed revocation broadcast goes unnoticed. Tokens are never trusted past their expiration. |
 | `DOCS_UI` | `rapidoc` | The UI library to use for the documentation. Allowed values are `swagger_ui`, `redoc`, `rapidoc` and `elements`. |
 | `MAIL_SERVER` | `localhost` | The mail server to use for sending emails. |
 | `MAIL_PORT` | `25` | The port to use for sending emails. |
@@ -0,0 +1,40 @@
+"""
+Write-behind tracking of the users' activity.
+
+Authenticated requests only record when their user was seen in the memory
+of the worker. A background task writes the buffered times to the users
+table in batches, so that no request pays for a write transaction. The
+task also runs when a worker exits normally, a worker that is killed loses
+the times of up to ACTIVITY_FLUSH_INTERVAL seconds.
+"""
+import threading
+from datetime import datetime
+
+
+class ActivityBuffer:
+    """The last time each user was seen by this worker, not yet saved."""
+
+    def __init__(self) -> None:
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def touch(self, user_id: int, when: datetime) -> None:
+        """Records that a user was seen at the given time."""
+        with self._lock:
+            last = self._seen.get(user_id)
+            if last is None or last < when:
+                self._seen[user_id] = when
+
+    def drain(self) -> dict:
+        """Returns the buffered times by user id and empties the buffer."""
+        with self._lock:
+            seen, self._seen = self._seen, {}
+        return seen
+
+    def restore(self, seen: dict) -> None:
+        """Puts back times that could not be saved, keeping newer ones."""
+        for user_id, when in seen.items():
+            self.touch(user_id, when)
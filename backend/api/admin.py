@@ -0,0 +1,36 @@
+from flask import Blueprint, abort
+from apifairy import authenticate, other_responses
+
+from api.app import cache
+from api.auth import token_auth, role_required
+
+admin_bp = Blueprint('admin', __name__)
+
+
+@admin_bp.route('/admin/cache/metrics', methods=['GET'], strict_slashes=False)
+@authenticate(token_auth)
+@role_required('admin')
+@other_responses({403: 'Action denied', 404: 'Caching is disabled'})
+def cache_metrics():
+    """Retrieve the cache metrics
+
+    Returns hit, miss and set counters per key prefix, latency histograms per
+    cache operation, event counters such as coalesced misses, and a capped
+    list of sampled calls. Workers write their metrics every
+    CACHE_METRICS_INTERVAL seconds.
+    """
+    if cache is None:
+        abort(404)
+    return cache.stats()
+
+
+@admin_bp.route('/admin/cache/metrics', methods=['DELETE'], strict_slashes=False)
+@authenticate(token_auth)
+@role_required('admin')
+@other_responses({403: 'Action denied', 404: 'Caching is disabled'})
+def reset_cache_metrics():
+    """Reset the cache metrics"""
+    if cache is None:
+        abort(404)
+    cache.metrics.reset()
+    return {}, 204
@@ -9,6 +9,8 @@ from flask_mail import Mail
 from apifairy import APIFairy
 from config import Config
 from api.redis import Cache
+from api.tasks import Scheduler
+from api.activity import ActivityBuffer
 from config import as_bool
 import stripe
 import os
@@ -19,6 +21,8 @@ cors = CORS()
 mail = Mail()
 migrate = Migrate()
 apifairy = APIFairy()
+scheduler = Scheduler()
+activity = ActivityBuffer()
 cache = None
 if as_bool(os.environ.get('USE_CACHE')):
     cache = Cache()
@@ -50,6 +54,13 @@ def create_app(config_class=Config):
         cors.init_app(app, resources={r"/*": {"origins": "*"}})
 
     apifairy.init_app(app)
+    scheduler.init_app(app)
+
+    from api.limiter import limiter
+    limiter.init_app(app)
+
+    from api.auth import forget_verified_tokens
+    app.teardown_request(forget_verified_tokens)
 
     # Register blueprints
     from api import models
@@ -75,6 +86,9 @@ def create_app(config_class=Config):
     from api.orders import orders_bp
     app.register_blueprint(orders_bp, url_prefix='/api')
 
+    from api.admin import admin_bp
+    app.register_blueprint(admin_bp, url_prefix='/api')
+
     if not cache:
         print("WARNING: Redis caching is disabled for this application!")
 
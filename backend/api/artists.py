@@ -9,11 +9,14 @@ from api import db
 from api.app import cache
 from api.models import Artist
 from api.schemas import ArtistSchema, DateTimePaginationSchema
-from api.decorators import paginated_response
+from api.decorators import paginated_response, entity_response
+from api import loaders
 from api.auth import token_auth, role_required
 from api.utilities import allowed_file
+from api.limiter import limit_blueprint
 
 artists_bp = Blueprint('artists', __name__)
+limit_blueprint(artists_bp)
 
 artist_schema = ArtistSchema()
 artists_schema = ArtistSchema(many=True)
@@ -58,7 +61,7 @@ def create_artist(data):
         db.session.add(artist)
         db.session.commit()
         if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+            cache.invalidate('artists')
     except IOError as io_err:
         db.session.rollback()
         if os.path.exists(artist_image_path):
@@ -79,7 +82,9 @@ def create_artist(data):
 @authenticate(token_auth)
 @paginated_response(artists_schema, order_by=Artist.timestamp,
                     order_direction='desc',
-                    pagination_schema=DateTimePaginationSchema)
+                    pagination_schema=DateTimePaginationSchema,
+                    cache_tags=('artists',), stale_ttl=10,
+                    loader=loaders.ARTISTS)
 def get_artists():
     """Retrieve all artists"""
     return db.session.query(Artist) or abort(404)
@@ -98,11 +103,11 @@ def get_artist_names():
 
 @artists_bp.route('/artists/<name>', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@response(artists_schema)
+@entity_response(artists_schema, Artist, column='name')
 @other_responses({404: 'Products not found'})
 def get_artist(name):
     """Retrieve artist by name"""
-    return db.session.query(Artist).filter_by(name=name) or abort(404)
+    return db.session.query(Artist).filter_by(name=name).all() or abort(404)
 
 
 @artists_bp.route('/artists/<int:id>', strict_slashes=False, methods=['DELETE'])
@@ -115,6 +120,7 @@ def delete_artist(id):
     db.session.delete(artist)
     db.session.commit()
     if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+        # Products cascade with their artist
+        cache.invalidate('artists', 'products')
 
     return {}, 204
\ No newline at end of file
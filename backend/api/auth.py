@@ -1,5 +1,6 @@
-from flask import current_app, abort
+from flask import current_app, abort, g, request
 from functools import wraps
+import sqlalchemy as sa
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from werkzeug.exceptions import Unauthorized, Forbidden
 
@@ -13,9 +14,12 @@ token_auth = HTTPTokenAuth()
 @basic_auth.verify_password
 def verify_password(username, password):
     if username and password:
-        user = db.session.query(User).filter_by(username=username).first()
-        if user is None:
-            user = db.session.query(User).filter_by(email=username).first()
+        # Usernames win over emails when both match, as in two lookups
+        user = db.session.scalar(
+            sa.select(User)
+            .where(sa.or_(User.username == username, User.email == username))
+            .order_by(sa.case((User.username == username, 0), else_=1))
+            .limit(1))
         if user and user.verify_password(password):
             return user
 
@@ -37,11 +41,30 @@ def verify_token(access_token):
         user.ping()
         return user
     if access_token:
-        user = User.verify_access_token(access_token)
-        return user
+        # Memoized, request_user() may have verified the token already
+        verified = g.setdefault('verified_tokens', {})
+        if access_token not in verified:
+            verified[access_token] = User.verify_access_token(access_token)
+        return verified[access_token]
     return None
 
 
+def forget_verified_tokens(exception=None):
+    """Drop the tokens verified by a request once it is done, in case its
+    app context outlives it, as in tests."""
+    g.pop('verified_tokens', None)
+
+
+def request_user():
+    """Return the user of the request's bearer token, or None, before or
+    without authentication by token_auth, e.g. to rate limit per user."""
+    scheme, _, access_token = request.headers.get(
+        'Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not access_token:
+        return None
+    return verify_token(access_token.strip())
+
+
 @token_auth.error_handler
 def token_auth_error(status=401):
     error = (Forbidden if status == 403 else Unauthorized)()
@@ -0,0 +1,109 @@
+"""
+Micro benchmarks run from the command line against a seeded database, e.g.
+after `flask fakes create 20`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+from timeit import default_timer as timer
+
+from flask import current_app
+
+from api.app import db
+from api.auth import verify_password
+from api.codecs import Serializer, msgpack, zstandard
+from api.models import Product, Token
+from api.schemas import ProductSchema
+
+
+def cache_codecs(pages=20, limit=25, rounds=50):
+    """Compare payload size and encode/decode time of the cache codecs.
+
+    Each page of the catalog is dumped with ProductSchema, like the product
+    listing does, then encoded and decoded `rounds` times per codec.
+    """
+    schema = ProductSchema(many=True)
+    payloads = []
+    for page in range(pages):
+        products = db.session.scalars(
+            db.select(Product).order_by(Product.timestamp.desc())
+            .limit(limit).offset(page * limit)).all()
+        if not products:
+            break
+        payloads.append({'data': schema.dump(products),
+                         'timestamp': products[0].timestamp})
+    if not payloads:
+        print("The catalog is empty, seed it with 'flask fakes create'.")
+        return
+
+    configs = [('json', ''), ('json', 'gzip')]
+    if msgpack is not None:
+        configs += [('msgpack', ''), ('msgpack', 'gzip')]
+    if zstandard is not None:
+        configs += [('json', 'zstd')]
+        if msgpack is not None:
+            configs += [('msgpack', 'zstd')]
+
+    print("{} pages of up to {} products, {} rounds".format(
+        len(payloads), limit, rounds))
+    print("{:<16}{:>12}{:>14}{:>14}".format(
+        'codec', 'bytes/page', 'encode (us)', 'decode (us)'))
+    for codec, compression in configs:
+        serializer = Serializer(codec, compression, min_size=1 if compression else 0)
+        encoded = [serializer.encode(payload) for payload in payloads]
+        start = timer()
+        for _ in range(rounds):
+            for payload in payloads:
+                serializer.encode(payload)
+        encode_time = timer() - start
+        start = timer()
+        for _ in range(rounds):
+            for data in encoded:
+                serializer.decode(data)
+        decode_time = timer() - start
+        runs = rounds * len(payloads)
+        print("{:<16}{:>12}{:>14.1f}{:>14.1f}".format(
+            '+'.join(filter(None, (codec, compression))),
+            sum(map(len, encoded)) // len(payloads),
+            encode_time / runs * 1e6, decode_time / runs * 1e6))
+
+
+def login_throughput(username='testuser', password='123456', logins=40,
+                     concurrency=(1, 2, 4, 8)):
+    """Measure the logins per second of the credential check and token
+    creation done by POST /api/tokens, with a number of concurrent clients.
+
+    Each login runs in its own thread and app context, like the requests of
+    a threaded worker. The user is one of those created by
+    'flask fakes create'.
+    """
+    app = current_app._get_current_object()
+
+    def login():
+        with app.app_context():
+            start = timer()
+            user = verify_password(username, password)
+            if user is None:
+                raise ValueError('Invalid username or password')
+            token = Token(user_id=user.id)
+            token.generate()
+            db.session.add(token)
+            db.session.commit()
+            return timer() - start
+
+    try:
+        login()
+    except ValueError as e:
+        print("{}, seed users with 'flask fakes create'.".format(e))
+        return
+
+    print("{} logins as {} with {}, {} hashing threads".format(
+        logins, username, app.config['PASSWORD_HASH_METHOD'],
+        app.config['PASSWORD_HASH_WORKERS']))
+    print("{:<12}{:>14}{:>16}".format('clients', 'logins/s', 'median (ms)'))
+    for clients in concurrency:
+        with ThreadPoolExecutor(clients) as executor:
+            start = timer()
+            latencies = list(executor.map(lambda _: login(), range(logins)))
+            elapsed = timer() - start
+        print("{:<12}{:>14.1f}{:>16.1f}".format(
+            clients, logins / elapsed, median(latencies) * 1000))
@@ -1,4 +1,5 @@
 import os
+import sqlalchemy as sa
 import stripe
 from flask import Blueprint, abort, jsonify, request
 from flask import current_app as app
@@ -7,12 +8,15 @@ from api import db
 from api.app import cache
 from api.schemas import CartSchema, DateTimePaginationSchema
 from api.decorators import paginated_response
+from api import loaders
 from api.tokens import token_auth
 from api.auth import role_required
 from api.models import Cart, User, Product
 from apifairy import authenticate, response, other_responses
+from api.limiter import limit_blueprint
 
 carts_bp = Blueprint('carts', __name__)
+limit_blueprint(carts_bp)
 
 cart_schema = CartSchema()
 carts_schema = CartSchema(many=True)
@@ -21,7 +25,9 @@ update_cart_schema = CartSchema(partial=True)
 
 @carts_bp.route('/carts', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema)
+@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema,
+                    cache_tags=('carts', 'products', 'users'), scope='role',
+                    total_mode='cached', loader=loaders.CARTS)
 @role_required('admin')
 def get_all_cart():
     """Get all carts"""
@@ -31,7 +37,10 @@ def get_all_cart():
 
 @carts_bp.route('/me/carts', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema)
+@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema,
+                    cache_tags=lambda **kwargs: (
+                        f'cart:{token_auth.current_user().id}', 'products', 'users'),
+                    scope='user', total_mode='cached', loader=loaders.CARTS)
 def get_my_cart():
     """Return the cart of the current user"""
     user = token_auth.current_user()
@@ -39,9 +48,8 @@ def get_my_cart():
     # Get the cart query
     carts = db.session.query(Cart).filter_by(customer_id=user.id)
 
-    # Calculate the total price of all items in the cart
-    price_list = [cart.quantity * cart.product.price for cart in carts]
-    total_price = sum(price_list)
+    # Calculate the total price of all items in the cart, in one aggregate
+    total_price = Cart.total(user.id)
     
     # Pass the total price as extra data
     return carts, {'extra_data': {'total_price': total_price, 'plus_tax': total_price + total_price * 0.1}}
@@ -50,7 +58,9 @@ def get_my_cart():
 
 @carts_bp.route('/carts/<name>', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema)
+@paginated_response(carts_schema, order_by=Cart.timestamp, order_direction='desc', pagination_schema=DateTimePaginationSchema,
+                    cache_tags=('carts', 'products', 'users'), scope='role',
+                    total_mode='cached', loader=loaders.CARTS)
 @role_required('admin')
 def get_user_cart(name):
     """Return the cart of a specific user"""
@@ -106,8 +116,6 @@ def order():
             success_url=success_url,
             cancel_url=cancel_url,
         )
-        if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
 
         return jsonify({"session_url": checkout_session.url})
 
@@ -127,7 +135,7 @@ def remove_cart(id):
     db.session.delete(cart)
     db.session.commit()
     if cache is not None:
-        cache.flush() # Clear the cache. # Clear the cache.
+        cache.invalidate('carts', f'cart:{cart.customer_id}')
 
     return {}
 
@@ -145,7 +153,7 @@ def remove_cart_product(id):
         db.session.delete(cart)
         db.session.commit()
         if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+            cache.invalidate('carts', f'cart:{customer_id}')
         return {}, 204
     except Exception as e:
         print("Error occurred:", e)
@@ -156,104 +164,95 @@ def remove_cart_product(id):
 @authenticate(token_auth)
 @response(cart_schema, 201)
 def add_to_cart(item_id):
-    """Add a product to cart"""
-    selected_size = request.get_json().get('size')  # Get size from query parameter
-    print(selected_size)
+    """Add a product to cart
 
+    Adding a product of a size already in the cart increments its quantity.
+    """
+    selected_size = request.get_json().get('size')
     if not selected_size:
         return abort(400, 'Size is required')
 
-    item_to_add = Product.query.get(item_id)
-    if not item_to_add:
+    if db.session.get(Product, item_id) is None:
         return abort(404, 'Product not found')
 
-    # Check if the same item with the same size exists in the cart
-    item_exists = Cart.query.filter_by(
-        product_id=item_id, 
-        customer_id=token_auth.current_user().id, 
-        size=selected_size
-    ).first()
-
-    if item_exists:
-        print("Item exists")
-        try:
-            item_exists.quantity = item_exists.quantity + 1
-            db.session.commit()
-            if cache is not None:
-                cache.flush() # Clear the cache.
-            return item_exists
-        except Exception as e:
-            print('Quantity not Updated', e)
-            return abort(500, f'Quantity not Updated: {e}')
-
-    # new_cart_item = Cart(quantity=1, product_id=item_to_add.id, customer_id=token_auth.current_user().id)
-    new_cart_item = Cart(
-        quantity=1, 
-        product_id=item_to_add.id, 
-        customer_id=token_auth.current_user().id, 
-        size=selected_size
-    )
-    print("New cart id: ", new_cart_item.id)
+    customer_id = token_auth.current_user().id
     try:
-        db.session.add(new_cart_item)
+        Cart.add(customer_id, item_id, selected_size)
         db.session.commit()
-        if cache is not None:
-            cache.flush() # Clear the cache.
-        return new_cart_item
     except Exception as e:
+        db.session.rollback()
         print('Item not added to cart', e)
         return abort(500, f'Quantity not Updated: {e}')
+    if cache is not None:
+        cache.invalidate('carts', f'cart:{customer_id}')
+    return db.session.scalar(sa.select(Cart).filter_by(
+        customer_id=customer_id, product_id=item_id, size=selected_size))
+
+
+def cart_item_id(customer_id, product_id):
+    """Return the id of the cart item of a product, of the size given in the
+    request body if any, or abort with a 404."""
+    size = (request.get_json(silent=True) or {}).get('size')
+    query = sa.select(Cart.id).filter_by(
+        customer_id=customer_id, product_id=product_id)
+    if size:
+        query = query.filter_by(size=size)
+    return db.session.scalar(query.order_by(Cart.id).limit(1)) or abort(404)
+
+
+def updated_cart_item(id, customer_id):
+    """Return a cart item after a change of its quantity, with the price of
+    the whole cart, committing it."""
+    total_price = Cart.total(customer_id)
+    item = db.session.get(Cart, id, populate_existing=True)
+    if item is None:
+        # The last one was removed, the item is reported as empty
+        item = Cart(id=id, quantity=0, customer_id=customer_id)
+    item.total_price = total_price
+    db.session.commit()
+    if cache is not None:
+        cache.invalidate('carts', f'cart:{customer_id}')
+    return item
 
 
 @carts_bp.route('/me/carts/incr/<int:item_id>', methods=['PUT'])
 @authenticate(token_auth)
 @response(cart_schema, 201)
 def incr_quantity(item_id):
-    """Increment the quantity of a product in the cart by 1"""
+    """Increment the quantity of a product in the cart by 1
+
+    The body may give the size of the product, otherwise its first cart item
+    is incremented.
+    """
     customer_id = token_auth.current_user().id
-    item_exists = Cart.query.filter_by(product_id=item_id, customer_id=customer_id).first()
-    if item_exists:
-        try:
-            item_exists.quantity = item_exists.quantity + 1
-            carts = db.session.query(Cart).filter_by(customer_id=customer_id)
-
-            # Calculate the total price of all items in the cart
-            price_list = [cart.quantity * cart.product.price for cart in carts]
-            item_exists.total_price = sum(price_list)
-            db.session.commit()
-            if cache is not None:
-                cache.flush() # Clear the cache.
-            
-            # Pass the total price as extra data
-            return item_exists
-        except Exception as e:
-            print('Quantity not Updated', e)
-            return abort(500, f'Quantity not Updated: {e}')
-    return abort(404)
+    id = cart_item_id(customer_id, item_id)
+    try:
+        db.session.execute(
+            sa.update(Cart).where(Cart.id == id)
+            .values(quantity=Cart.quantity + 1)
+            .execution_options(synchronize_session=False))
+        return updated_cart_item(id, customer_id)
+    except Exception as e:
+        db.session.rollback()
+        print('Quantity not Updated', e)
+        return abort(500, f'Quantity not Updated: {e}')
 
 @carts_bp.route('/me/carts/decr/<int:item_id>', methods=['PUT'])
 @authenticate(token_auth)
 @response(cart_schema, 201)
 @other_responses({500: 'Quantity not updated!', 404: 'Products not found'})
 def decr_quantity(item_id):
-    """decrement the quantity of a product in the cart by 1"""
+    """decrement the quantity of a product in the cart by 1
+
+    The item is removed from the cart when its quantity reaches 0, and is
+    then returned with a quantity of 0.
+    """
     customer_id = token_auth.current_user().id
-    item_exists = Cart.query.filter_by(product_id=item_id, customer_id=token_auth.current_user().id).first()
-    if item_exists:
-        try:
-            item_exists.quantity = item_exists.quantity - 1
-            carts = db.session.query(Cart).filter_by(customer_id=customer_id)
-
-            # Calculate the total price of all items in the cart
-            price_list = [cart.quantity * cart.product.price for cart in carts]
-            item_exists.total_price = sum(price_list)
-            db.session.commit()
-            if cache is not None:
-                cache.flush() # Clear the cache.
-            
-            # Pass the total price as extra data
-            return item_exists
-        except Exception as e:
-            print('Quantity not Updated', e)
-            return abort(500, f'Quantity not Updated: {e}')
-    return abort(404)
\ No newline at end of file
+    id = cart_item_id(customer_id, item_id)
+    try:
+        Cart.remove(id)
+        return updated_cart_item(id, customer_id)
+    except Exception as e:
+        db.session.rollback()
+        print('Quantity not Updated', e)
+        return abort(500, f'Quantity not Updated: {e}')
\ No newline at end of file
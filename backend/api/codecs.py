@@ -0,0 +1,161 @@
+"""
+Codecs used to store python values in the redis cache.
+
+Every encoded value starts with a two byte header naming its codec and
+compression, so values written with one configuration can still be read
+after CACHE_CODEC or CACHE_COMPRESSION change.
+"""
+from datetime import datetime, date
+from typing import Any
+import gzip
+import json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+DATETIME_EXT = 1
+DATE_EXT = 2
+
+
+class JSONCodec:
+    """Encodes values as JSON, keeping datetimes as tagged ISO strings."""
+    id = 1
+    name = 'json'
+
+    @staticmethod
+    def _default(obj: Any) -> dict:
+        if isinstance(obj, datetime):
+            return {'__datetime__': obj.isoformat()}
+        if isinstance(obj, date):
+            return {'__date__': obj.isoformat()}
+        raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+    @staticmethod
+    def _object_hook(obj: dict) -> Any:
+        if '__datetime__' in obj:
+            return datetime.fromisoformat(obj['__datetime__'])
+        if '__date__' in obj:
+            return date.fromisoformat(obj['__date__'])
+        return obj
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(value, separators=(',', ':'),
+                          default=self._default).encode()
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data, object_hook=self._object_hook)
+
+
+class MsgpackCodec:
+    """Encodes values as msgpack, keeping datetimes as extension types."""
+    id = 2
+    name = 'msgpack'
+
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise RuntimeError("The msgpack codec requires the msgpack package")
+
+    @staticmethod
+    def _default(obj: Any) -> Any:
+        if isinstance(obj, datetime):
+            return msgpack.ExtType(DATETIME_EXT, obj.isoformat().encode())
+        if isinstance(obj, date):
+            return msgpack.ExtType(DATE_EXT, obj.isoformat().encode())
+        raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+    @staticmethod
+    def _ext_hook(code: int, data: bytes) -> Any:
+        if code == DATETIME_EXT:
+            return datetime.fromisoformat(data.decode())
+        if code == DATE_EXT:
+            return date.fromisoformat(data.decode())
+        return msgpack.ExtType(code, data)
+
+    def encode(self, value: Any) -> bytes:
+        return msgpack.packb(value, default=self._default, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False,
+                               strict_map_key=False)
+
+
+NO_COMPRESSION = 0
+GZIP = 1
+ZSTD = 2
+# 'zlib' is the former name of 'gzip'
+COMPRESSIONS = {'': NO_COMPRESSION, 'none': NO_COMPRESSION, 'gzip': GZIP,
+                'zlib': GZIP, 'zstd': ZSTD}
+CODECS = {JSONCodec.id: JSONCodec, MsgpackCodec.id: MsgpackCodec}
+
+
+def compress(data: bytes, compression: int) -> bytes:
+    """Compresses data with one of the COMPRESSIONS. Gzip is also used
+    for the response bodies stored in the cache."""
+    if compression == GZIP:
+        return gzip.compress(data, compresslevel=6)
+    if compression == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decompress(data: bytes, compression: int) -> bytes:
+    """Reverts compress()."""
+    if compression == GZIP:
+        return gzip.decompress(data)
+    if compression == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class Serializer:
+    """
+        Encodes values with a codec, compressing those larger than a
+        threshold, and decodes anything encoded by any Serializer.
+    """
+
+    def __init__(self, codec: str = 'json', compression: str = '',
+                 min_size: int = 0) -> None:
+        """Instantiates a serializer.
+
+        Args:
+            codec (str): 'json' or 'msgpack'
+            compression (str): '', 'gzip' or 'zstd'
+            min_size (int): Size in bytes from which values are compressed,
+                0 disables compression
+        """
+        codecs = {cls.name: cls for cls in CODECS.values()}
+        if codec not in codecs:
+            raise ValueError(f"Unknown cache codec '{codec}'")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression '{compression}'")
+        self.codec = codecs[codec]()
+        self.compression = COMPRESSIONS[compression] if min_size else \
+            NO_COMPRESSION
+        if self.compression == ZSTD and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        self.min_size = min_size
+        self._codecs = {self.codec.id: self.codec}
+
+    def encode(self, value: Any) -> bytes:
+        """Returns the header and the encoded, possibly compressed, value."""
+        data = self.codec.encode(value)
+        compression = NO_COMPRESSION
+        if self.compression and len(data) >= self.min_size:
+            compression = self.compression
+            data = compress(data, compression)
+        return bytes((self.codec.id, compression)) + data
+
+    def decode(self, data: bytes) -> Any:
+        """Decodes a value returned by any Serializer's encode()."""
+        codec_id, compression = data[0], data[1]
+        codec = self._codecs.get(codec_id)
+        if codec is None:
+            codec = self._codecs[codec_id] = CODECS[codec_id]()
+        return codec.decode(decompress(data[2:], compression))
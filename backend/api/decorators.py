@@ -1,38 +1,261 @@
 from apifairy import arguments, response
-from flask import abort, jsonify, request
-from functools import wraps
+from flask import abort, jsonify, request, current_app, g, \
+    copy_current_request_context
+from functools import wraps, lru_cache
+from threading import Thread
 import sqlalchemy as sqla
+import base64
+import hashlib
+import gzip
 import json
 
-from api.schemas import StringPaginationSchema, PaginatedCollection
+from marshmallow import ValidationError
+
+from api.schemas import StringPaginationSchema, PaginatedCollection, \
+    narrowed_schema
+from api.auth import token_auth
 from api.app import cache
 from api.app import db
+from api.redis import compress_body, is_compressed
+from api.codecs import JSONCodec
+from api.loaders import strict_loading
+
+CACHE_SCOPES = ('public', 'user', 'role')
+PAGINATION_ARGS = ('limit', 'offset', 'after', 'cursor', 'fields')
+TOTAL_MODES = ('exact', 'cached', 'estimate', 'none')
+ENTITY_TTL = 300
+
+
+def cache_key(scope='public'):
+    """Build the cache key of the current request.
+
+    Public pages are shared by everyone, while 'user' and 'role' scoped pages
+    are namespaced by the authenticated user or by their role. Returns None
+    when a scoped page is requested without an authenticated user, in which
+    case the response is not cached.
+    """
+    key = f"{request.path}:{json.dumps(request.args, sort_keys=True)}"
+    if scope != 'public':
+        user = token_auth.current_user()
+        if user is None:
+            return None
+        if scope == 'user':
+            key = f"user:{user.id}:{key}"
+        else:
+            key = f"role:{user.role}:{key}"
+    return cache.versioned('pages', key)
+
+
+def encode_cursor(row, key_columns, backwards=False):
+    """Return an opaque cursor pointing after (or before) the given row."""
+    position = [getattr(row, column.key) for column in key_columns]
+    data = JSONCodec().encode([backwards, position])
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, order_by):
+    """Return the direction and position of a cursor, or abort with 400
+    when it is not a position on (order_by, id)."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        backwards, position = JSONCodec().decode(data)
+        value, id = position
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(backwards, bool) or type(id) is not int or \
+            not isinstance(value, cursor_type(order_by)):
+        abort(400)
+    return backwards, position
+
+
+def cursor_type(column):
+    """Return the python types a cursor may hold for a column."""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return (str, int, float, bool, type(None))
+    if python_type is float:
+        return (int, float)
+    return python_type
+
+
+def seek(select_query, key_columns, position, descending):
+    """Filter the rows ordered after a position on (order_by, id).
+
+    The comparison is expanded rather than written as a row value, so that
+    databases seek the (order_by, id) index instead of scanning it.
+    """
+    (column, id_column), (value, id) = key_columns, position
+    if descending:
+        return select_query.filter(sqla.or_(
+            column < value, sqla.and_(column == value, id_column < id)))
+    return select_query.filter(sqla.or_(
+        column > value, sqla.and_(column == value, id_column > id)))
+
+
+def count_rows(select_query):
+    """Count the rows of a query."""
+    return db.session.scalar(
+        sqla.select(sqla.func.count()).select_from(select_query.subquery()))
+
+
+def cached_count(select_query, tags, expire):
+    """Count the rows of a query, caching the count until the given tags
+    are invalidated, or for `expire` seconds at most."""
+    statement = sqla.select(sqla.func.count()).select_from(
+        select_query.order_by(None).subquery()).compile(db.engine)
+    signature = hashlib.sha1(
+        f"{statement}:{sorted(statement.params.items())}".encode()).hexdigest()
+    key = cache.versioned('counts', signature)
+    count = cache.get(key)
+    if count is None:
+        count = db.session.scalar(statement.statement)
+        cache.set(key, count, expire=expire, tags=tags)
+    return count
+
+
+def estimate_count(select_query):
+    """Estimate the number of rows of the table a query selects from.
+
+    The estimate comes from the statistics the database keeps, that is
+    information_schema on MySQL and sqlite_stat1 (written by ANALYZE) on
+    SQLite, and ignores the query's filters. Falls back to an exact count
+    when no statistics are available.
+    """
+    table = select_query.column_descriptions[0]['entity'].__tablename__
+    dialect = db.engine.dialect.name
+    estimate = None
+    try:
+        if dialect in ('mysql', 'mariadb'):
+            estimate = db.session.scalar(sqla.text(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = :table"),
+                {'table': table})
+        elif dialect == 'sqlite':
+            stats = db.session.scalars(sqla.text(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = :table"),
+                {'table': table}).all()
+            if stats:
+                # Each stat starts with the number of rows of the table
+                estimate = max(int(stat.split()[0]) for stat in stats)
+    except sqla.exc.DatabaseError:
+        db.session.rollback()
+    return estimate if estimate is not None else count_rows(select_query)
+
+
+def requested_fields():
+    """Return the sorted field names of the ?fields= argument, if any."""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return tuple(sorted({f.strip() for f in fields.split(',') if f.strip()}))
+
+
+def narrowed(schema, fields):
+    """Return the schema narrowed to the requested fields, or abort with
+    400 when some of them are unknown."""
+    try:
+        return narrowed_schema(schema, tuple(sorted(set(fields))))
+    except ValidationError as e:
+        abort(400, e.messages[0])
+
+
+def load_only(schema, fields, *extra):
+    """Return the load_only option of the columns needed to dump the given
+    fields of a SQLAlchemySchema.
+
+    Fields named after a column load it, relationships load their foreign
+    keys, and properties load the columns listed in the schema's
+    `field_columns`. `extra` columns, such as the ordering, are always
+    loaded.
+    """
+    model = schema.opts.model
+    mapper = sqla.inspect(model)
+    hints = getattr(schema, 'field_columns', {})
+    columns = {'id', *extra}
+    for name in fields:
+        field = schema.fields[name]
+        for attribute in hints.get(name, (field.attribute or name,)):
+            if attribute in mapper.relationships:
+                columns.update(
+                    mapper.get_property_by_column(column).key
+                    for column in mapper.relationships[attribute].local_columns
+                    if column.table is mapper.local_table)
+            elif attribute in mapper.column_attrs:
+                columns.add(attribute)
+    return sqla.orm.load_only(*[getattr(model, c) for c in sorted(columns)])
+
+
+def body_response(body):
+    """Return a cached JSON body, still gzipped if the client accepts it."""
+    headers = {}
+    if is_compressed(body):
+        headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in request.accept_encodings:
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            body = gzip.decompress(body)
+    return current_app.response_class(body, mimetype='application/json',
+                                      headers=headers)
 
 
 def paginated_response(schema, max_limit=25, order_by=None,
                        order_direction='asc',
                        pagination_schema=StringPaginationSchema,
-                       cache_ttl=1000):  # Allow configurable cache TTL
+                       cache_ttl=1000,  # Allow configurable cache TTL
+                       cache_tags=(), scope='public', stale_ttl=None,
+                       total_mode='exact', loader=()):
+    """Paginate the query returned by the decorated route.
+
+    `scope` tells whether the page is the same for everyone ('public'),
+    depends on the authenticated user ('user') or on their role ('role'),
+    and namespaces the cache key accordingly.
+
+    `cache_tags` lists the entities a cached page depends on, so that writes
+    only invalidate the pages they affect. It can also be a callable that
+    receives the route's keyword arguments and returns the tags, for pages
+    that depend on the current user (e.g. 'cart:<user_id>').
+
+    With `stale_ttl`, a cached page older than `cache_ttl` is still served
+    for `stale_ttl` more seconds while it is rebuilt in the background.
+    Only public pages support it, as the rebuild runs without the user.
+
+    Pages are cached as their final JSON body, gzipped when larger than
+    CACHE_COMPRESS_MIN_SIZE, and returned as is on a hit.
+
+    With `order_by`, responses include opaque `next_cursor`/`prev_cursor`
+    values. Passing one back as `cursor` seeks to the neighbouring page on
+    (order_by, id), which stays fast however deep the page is.
+
+    `total_mode` tells how the `total` of the pagination is computed:
+    'exact' counts the rows on every request, 'cached' keeps the count per
+    query until `cache_tags` are invalidated or for `cache_ttl` seconds,
+    'estimate' reads the table size from the database statistics, and
+    'none' leaves it out, for clients that only need `has_more`.
+
+    Arguments of `pagination_schema` other than the pagination ones, such
+    as filters, are passed to the route as keyword arguments.
+
+    `loader` is the loader profile of the page (see api/loaders.py), the
+    SQLAlchemy options that eagerly load what `schema` serializes.
+    """
+    if scope not in CACHE_SCOPES:
+        raise ValueError(f"Invalid cache scope '{scope}'")
+    if total_mode not in TOTAL_MODES:
+        raise ValueError(f"Invalid total mode '{total_mode}'")
+    if stale_ttl and scope != 'public':
+        raise ValueError("stale_ttl is only supported on public pages")
 
     def inner(route_function):
         @wraps(route_function)
         def paginate(*args, **kwargs):
             args = list(args)
             pagination = args.pop(-1)
-            response = None
-
-            if cache:
-                # Generate a unique cache key based on the request URL and pagination parameters
-                cache_key = f"{request.path}:{json.dumps(request.args, sort_keys=True)}"
-
-                # Check if response exists in cache
-                response = cache.get(cache_key)
-                if response:
-                    response['source'] = 'cache'
-                    return response
+            filters = {name: value for name, value in pagination.items()
+                       if name not in PAGINATION_ARGS}
 
-            # If response is not cached, execute the original route function
-            result = route_function(*args, **kwargs)
+            # Execute the original route function
+            result = route_function(*args, **kwargs, **filters)
 
             # Process the result (pagination logic)
             if isinstance(result, tuple):
@@ -40,61 +263,296 @@ def paginated_response(schema, max_limit=25, order_by=None,
             else:
                 select_query = result
                 extra_data = {}
+            if loader:
+                select_query = select_query.options(*loader)
+            fields = requested_fields()
+            if fields:
+                # Only read the columns of the requested fields
+                select_query = select_query.options(load_only(
+                    schema, fields,
+                    *([order_by.key] if order_by is not None else [])))
 
             if order_by is not None:
-                o = order_by.desc() if order_direction == 'desc' else order_by
-                select_query = select_query.order_by(o)
+                # The id breaks ties, so that rows have a stable order
+                key_columns = (order_by, order_by.class_.id)
+                descending = order_direction == 'desc'
+                select_query = select_query.order_by(
+                    *[c.desc() if descending else c for c in key_columns])
 
-            count = db.session.scalar(
-                sqla.select(sqla.func.count()).select_from(select_query.subquery())
-            )
+            if total_mode == 'none':
+                count = None
+            elif total_mode == 'estimate':
+                count = estimate_count(select_query)
+            elif total_mode == 'cached' and cache:
+                tags = cache_tags(**kwargs) if callable(cache_tags) \
+                    else cache_tags
+                count = cached_count(select_query, tags, cache_ttl)
+            else:
+                count = count_rows(select_query)
 
             limit = pagination.get('limit', max_limit)
             offset = pagination.get('offset')
             after = pagination.get('after')
+            cursor = pagination.get('cursor')
             if limit > max_limit:
                 limit = max_limit
+            if limit <= 0:
+                abort(400)
 
-            if after is not None:
+            backwards = False
+            if cursor is not None:
+                if order_by is None:
+                    abort(400)
+                backwards, position = decode_cursor(cursor, order_by)
+                query = seek(select_query, key_columns, position,
+                             descending != backwards)
+                if backwards:
+                    query = query.order_by(None).order_by(
+                        *[c if descending else c.desc() for c in key_columns])
+                offset = None
+            elif after is not None:
                 if offset is not None or order_by is None:
                     abort(400)
-                order_condition = order_by < after if order_direction == 'desc' else order_by > after
-                query = select_query.limit(limit).filter(order_condition)
-                offset = db.session.scalar(
-                    sqla.select(sqla.func.count())
-                        .select_from(select_query.filter(order_condition).subquery())
-                )
+                order_condition = order_by < after if descending else order_by > after
+                query = select_query.filter(order_condition)
             else:
                 if offset is None:
                     offset = 0
-                if offset < 0 or (count > 0 and offset >= count) or limit <= 0:
+                # Estimates may be below the actual number of rows
+                if offset < 0 or (total_mode != 'estimate' and count and
+                                  offset >= count):
                     abort(400)
-                query = select_query.limit(limit).offset(offset)
+                query = select_query.offset(offset)
 
-            data = db.session.scalars(query).all()
+            # One extra row tells whether there is a page after this one
+            query = query.limit(limit + 1)
+            if isinstance(query, sqla.orm.Query):
+                # Executing a legacy Query as a statement drops its eager
+                # loads, and so its loader profile
+                data = query.all()
+            else:
+                data = db.session.scalars(query).all()
+            has_more = len(data) > limit
+            data = data[:limit]
+            if backwards:
+                data.reverse()
+            has_next = backwards or has_more
 
             # Construct the response as a dictionary
             response = {
-                'data': schema.dump(data, many=True),
+                'data': data,
                 'pagination': {
                     'offset': offset,
                     'limit': limit,
                     'count': len(data),
                     'total': count,
+                    'has_more': has_next,
                 },
             }
+            if order_by is not None and data:
+                has_prev = has_more if backwards else \
+                    cursor is not None or after is not None or bool(offset)
+                if has_next:
+                    response['next_cursor'] = encode_cursor(
+                        data[-1], key_columns)
+                if has_prev:
+                    response['prev_cursor'] = encode_cursor(
+                        data[0], key_columns, backwards=True)
             response.update(extra_data)
             response['source'] = 'db'  # Add source info for uncached responses
 
-            if cache:
-                # Cache the response for a specific TTL
-                cache.set(cache_key, json.dumps(response), expire=cache_ttl)
-
             # Return the response as a dict, which will be processed by @response decorator
-            response['data'] = data
             return response  # Return as a dictionary instead of jsonify
 
-        return arguments(pagination_schema)(response(PaginatedCollection(
-            schema, pagination_schema=pagination_schema))(paginate))
+        serialized = response(PaginatedCollection(
+            schema, pagination_schema=pagination_schema))(paginate)
+
+        @lru_cache(maxsize=64)
+        def serializer(fields):
+            """Return the route serializing the requested fields."""
+            if fields is None:
+                return serialized
+            return response(PaginatedCollection(
+                narrowed(schema, fields),
+                pagination_schema=pagination_schema))(paginate)
+
+        @wraps(serialized)
+        def paginated(*args, **kwargs):
+            with strict_loading():
+                return serializer(requested_fields())(*args, **kwargs)
+
+        def fill(key, *args, **kwargs):
+            """Build the requested page and store its encoded body under key."""
+            rv = paginated(*args, **kwargs)
+            json_response, status_code = rv
+            if key and status_code == 200:
+                # Cache the final body, so hits skip the schema entirely
+                payload = json_response.get_json()
+                payload['source'] = 'cache'
+                body = current_app.json.dumps(payload).encode()
+                tags = cache_tags(**kwargs) if callable(cache_tags) \
+                    else cache_tags
+                cache.set(key, compress_body(body),
+                          expire=cache_ttl + (stale_ttl or 0), tags=tags)
+            return rv
+
+        def revalidate(key, *args, **kwargs):
+            """Rebuild a stale page in the background, unless another caller
+            is already doing it."""
+            lock = cache.lock(key)
+            if lock is None:
+                return
+
+            @copy_current_request_context
+            def refresh():
+                try:
+                    fill(key, *args, **kwargs)
+                except Exception as e:
+                    print(f"Error refreshing {key}: {e}")
+                finally:
+                    cache.unlock(lock)
+
+            Thread(target=refresh, daemon=True).start()
+
+        @wraps(paginated)
+        def cached(*args, **kwargs):
+            if not cache:
+                return paginated(*args, **kwargs)
+
+            # Generate a unique cache key based on the request URL, pagination parameters and scope
+            key = cache_key(scope)
+            if not key:
+                return paginated(*args, **kwargs)
+
+            # Check if response exists in cache
+            body, ttl = cache.get_body(key)
+            if body is not None:
+                if stale_ttl and ttl is not None and ttl < stale_ttl:
+                    revalidate(key, *args, **kwargs)
+                return body_response(body)
+
+            # Only one caller rebuilds a missing page, the others wait for it
+            lock = cache.lock(key)
+            if lock is None:
+                body = cache.wait(key)
+                if body is not None:
+                    return body_response(body)
+
+            try:
+                return fill(key, *args, **kwargs)
+            finally:
+                if lock is not None:
+                    cache.unlock(lock)
+
+        return arguments(pagination_schema)(cached)
+
+    return inner
+
+
+def entity_key(model, column, value, fields=None):
+    """Build the cache key of an entity's body."""
+    key = f"{model.__tablename__}:{column}:{value}"
+    if fields:
+        key += f":{','.join(fields)}"
+    return cache.versioned('entities', key)
+
+
+def entity_tags(rows, depends_on=None):
+    """Return the cache tags of the body showing the given rows."""
+    tags = set()
+    for row in rows:
+        tags.add(row.cache_tag)
+        if depends_on is not None:
+            tags.update(depends_on(row))
+    return tags
+
+
+def entity_bodies(schema, model, values, column='id', cache_ttl=ENTITY_TTL,
+                  depends_on=None):
+    """Return the JSON bodies of the entities with the given values of
+    `column`, keyed by value, in one cache round trip and one IN query.
+
+    Bodies are shared with entity_response(), so each entity is read
+    through the same cache entry as when it is fetched on its own. Values
+    without a row are left out.
+    """
+    bodies = {}
+    if cache:
+        keys = [entity_key(model, column, value) for value in values]
+        for value, body in zip(values, cache.get_bodies(keys)):
+            if body is not None:
+                bodies[value] = gzip.decompress(body) \
+                    if is_compressed(body) else body
+
+    missing = [value for value in values if value not in bodies]
+    if missing:
+        attribute = getattr(model, column)
+        rows = db.session.scalars(
+            sqla.select(model).where(attribute.in_(missing))).all()
+        entries = []
+        for row in rows:
+            value = getattr(row, column)
+            bodies[value] = current_app.json.dumps(schema.dump(row)).encode()
+            if cache:
+                entries.append((entity_key(model, column, value),
+                                compress_body(bodies[value]),
+                                entity_tags([row], depends_on)))
+        if entries:
+            cache.set_many(entries, expire=cache_ttl)
+    return bodies
+
+
+def entity_response(schema, model, column='id', cache_ttl=ENTITY_TTL,
+                    depends_on=None):
+    """Serialize the entity returned by the decorated route, reading it
+    through the cache.
+
+    The route receives the primary key or unique `column` of `model` as the
+    keyword argument of the same name, and its cached body is keyed by them.
+    The body is tagged with the returned rows (see BaseModel.cache_tag), so
+    that committing a change to any of them invalidates it. `depends_on`
+    receives each row and returns the tags of other rows its body shows,
+    e.g. the artist of a product.
+
+    A ?fields= argument narrows the body to the given fields, each set of
+    fields being cached separately.
+    """
+    def inner(route_function):
+        @wraps(route_function)
+        def load(*args, **kwargs):
+            rv = route_function(*args, **kwargs)
+            g.entity_tags = entity_tags(
+                rv if isinstance(rv, list) else [rv], depends_on)
+            return rv
+
+        serialized = response(schema)(load)
+
+        @lru_cache(maxsize=64)
+        def serializer(fields):
+            """Return the route serializing the requested fields."""
+            if fields is None:
+                return serialized
+            return response(narrowed(schema, fields))(load)
+
+        @wraps(serialized)
+        def cached(*args, **kwargs):
+            fields = requested_fields()
+            responded = serializer(fields)
+            if not cache:
+                return responded(*args, **kwargs)
+
+            key = entity_key(model, column, kwargs[column], fields)
+            body, _ = cache.get_body(key)
+            if body is not None:
+                return body_response(body)
+
+            rv = responded(*args, **kwargs)
+            json_response, status_code = rv
+            if status_code == 200:
+                cache.set(key, compress_body(json_response.get_data()),
+                          expire=cache_ttl, tags=g.pop('entity_tags', ()))
+            return rv
+
+        return cached
 
     return inner
@@ -1,8 +1,8 @@
-from flask import Blueprint, current_app
+from flask import Blueprint, current_app, request
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from werkzeug.exceptions import HTTPException, InternalServerError
 
-from api.app import apifairy
+from api.app import apifairy, db
 
 errors_bp = Blueprint('errors', __name__)
 
@@ -18,6 +18,14 @@ def http_error(error):
  
 @errors_bp.app_errorhandler(IntegrityError)
 def sqlalchemy_integrity_error(error):  # pragma: no cover
+    from api.uniqueness import integrity_violations
+
+    errors = integrity_violations(error)
+    if errors:
+        # Taken values are reported like the schemas' uniqueness checks
+        db.session.rollback()
+        location = 'form' if request.form else 'json'
+        return validation_error(400, {location: errors})
     return {
         'code': 400,
         'message': 'Database integrity error',
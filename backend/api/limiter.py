@@ -1,11 +1,137 @@
+"""
+Rate limiting.
+
+Limits are counted in fixed windows in the storage of RATELIMIT_STORAGE_URI,
+redis in production. With the 'local-token-bucket' strategy, each worker
+spends a share of the budget left in a window without asking redis, and
+sends the requests it granted in one increment when that share runs out or
+every RATELIMIT_SYNC_INTERVAL seconds. Shares shrink as a window fills up,
+so that requests close to a limit are always counted in redis first.
+"""
+import math
 import os
-from flask import current_app as app
+import threading
+import time
 
+from flask import current_app
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.strategies import STRATEGIES, FixedWindowRateLimiter
+
+local_share: float = float(os.environ.get('RATELIMIT_LOCAL_SHARE') or '0.1')
+sync_interval: float = float(os.environ.get('RATELIMIT_SYNC_INTERVAL') or '1')
+max_buckets: int = 10000
+
+
+class LocalBucketRateLimiter(FixedWindowRateLimiter):
+    """A fixed window limiter answering clearly under budget requests from
+    the memory of the worker."""
+
+    def __init__(self, storage, share: float = local_share,
+                 interval: float = sync_interval) -> None:
+        super().__init__(storage)
+        self.share = share
+        self.interval = interval
+        # key -> [window reset time, count in storage, requests granted
+        # since, requests this worker may grant, monotonic sync time]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str):
+        """Returns the live bucket of a key, or None."""
+        bucket = self._buckets.get(key)
+        if bucket is not None and bucket[0] <= time.time():
+            del self._buckets[key]
+            return None
+        return bucket
+
+    def hit(self, item, *identifiers: str, cost: int = 1) -> bool:
+        key = item.key_for(*identifiers)
+        with self._lock:
+            bucket = self._bucket(key)
+            if bucket is not None and bucket[2] + cost <= bucket[3] and \
+                    time.monotonic() - bucket[4] < self.interval:
+                bucket[2] += cost
+                return True
+            pending = 0
+            if bucket is not None:
+                pending, bucket[2], bucket[3] = bucket[2], 0, 0
+        try:
+            count = self.storage.incr(key, item.get_expiry(),
+                                      amount=pending + cost)
+            reset = bucket[0] if bucket is not None else \
+                self.storage.get_expiry(key)
+        except Exception:
+            with self._lock:
+                self._buckets.pop(key, None)
+            raise
+        allowance = math.floor(max(0, item.amount - count) * self.share)
+        with self._lock:
+            if len(self._buckets) >= max_buckets:
+                now = time.time()
+                self._buckets = {k: b for k, b in self._buckets.items()
+                                 if b[0] > now}
+            self._buckets[key] = [reset, count, 0, allowance, time.monotonic()]
+        return count <= item.amount
+
+    def test(self, item, *identifiers: str, cost: int = 1) -> bool:
+        with self._lock:
+            bucket = self._bucket(item.key_for(*identifiers))
+            if bucket is not None:
+                return bucket[1] + bucket[2] < item.amount - cost + 1
+        return super().test(item, *identifiers, cost=cost)
+
+    def get_window_stats(self, item, *identifiers: str):
+        with self._lock:
+            bucket = self._bucket(item.key_for(*identifiers))
+        if bucket is None:
+            return super().get_window_stats(item, *identifiers)
+        stats = super().get_window_stats(item, *identifiers)
+        return stats._replace(
+            remaining=max(0, stats.remaining - bucket[2]))
+
+    def clear(self, item, *identifiers: str) -> None:
+        with self._lock:
+            self._buckets.pop(item.key_for(*identifiers), None)
+        super().clear(item, *identifiers)
+
+
+STRATEGIES['local-token-bucket'] = LocalBucketRateLimiter
+
+
+def rate_limit_key() -> str:
+    """Counts the requests of authenticated users per user, and the other
+    requests per client address."""
+    from api.auth import request_user
+
+    user = request_user()
+    if user is not None:
+        return f'user:{user.id}'
+    return get_remote_address()
+
+
+def budget(name: str):
+    """Returns a limit provider for the RATELIMIT_BUDGETS entry `name`,
+    which sets the budget of each role, of anonymous clients and of the
+    roles it doesn't list.
+    """
+    def provider() -> str:
+        from api.auth import request_user
+
+        budgets = current_app.config['RATELIMIT_BUDGETS'][name]
+        user = request_user()
+        if user is None:
+            return budgets['anonymous']
+        return budgets.get(user.role, budgets['default'])
+    return provider
+
+
+def limit_blueprint(blueprint) -> None:
+    """Applies the catalog budget to the reads of a blueprint and the
+    writes budget to its other routes."""
+    limiter.limit(budget('catalog'), methods=['GET'])(blueprint)
+    limiter.limit(budget('writes'),
+                  methods=['POST', 'PUT', 'PATCH', 'DELETE'])(blueprint)
+
 
-limiter = Limiter(
-    get_remote_address,
-    app=app,
-    default_limits=["200 per day", "50 per hour"],
-    storage_uri=os.environ.get("REDIS_URI"),)
\ No newline at end of file
+limiter = Limiter(rate_limit_key)
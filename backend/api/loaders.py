@@ -0,0 +1,70 @@
+"""
+Loader profiles of the paginated endpoints.
+
+A profile is a tuple of SQLAlchemy loader options applied to the query of
+a page, so that everything its schema serializes is loaded by a constant
+number of queries instead of one lazy load per row. When the
+RAISE_ON_LAZY_LOAD option is set, a lazy load while a page is built raises
+an error instead, which tests use to catch profiles that miss a
+relationship.
+"""
+from contextlib import contextmanager
+
+from flask import current_app
+import sqlalchemy as sa
+from sqlalchemy import orm as so
+
+from api.app import db
+from api.models import User, Product, Order, Cart
+
+CART_SIZE = sa.select(sa.func.count(Cart.id)).where(
+    Cart.customer_id == User.id).correlate(User).scalar_subquery()
+
+# ProductSchema shows the artist's description and website
+PRODUCTS = (so.joinedload(Product.artist),)
+
+ARTISTS = ()
+
+# UserSchema counts the user's cart items
+USERS = (so.with_expression(User._cart_size, CART_SIZE),)
+
+CARTS = (
+    so.joinedload(Cart.product).joinedload(Product.artist),
+    so.joinedload(Cart.customer),
+)
+
+ORDERS = (
+    so.selectinload(Order.products).joinedload(Product.artist),
+    so.joinedload(Order.customer).with_expression(User._cart_size,
+                                                  CART_SIZE),
+)
+
+
+class LazyLoadError(sa.exc.InvalidRequestError):
+    """A relationship missing from a loader profile was lazy loaded."""
+
+
+@contextmanager
+def strict_loading():
+    """Raise LazyLoadError on lazy loads in the block, if the application
+    is configured with RAISE_ON_LAZY_LOAD."""
+    if not current_app.config.get('RAISE_ON_LAZY_LOAD'):
+        yield
+        return
+    db.session.info['strict_loading'] = True
+    try:
+        yield
+    finally:
+        db.session.info.pop('strict_loading', None)
+
+
+@sa.event.listens_for(so.Session, 'do_orm_execute')
+def check_lazy_load(orm_execute_state):
+    if not orm_execute_state.is_select or \
+            not orm_execute_state.session.info.get('strict_loading'):
+        return
+    state = orm_execute_state.lazy_loaded_from
+    if state is not None:
+        raise LazyLoadError(
+            f"Unexpected lazy load from {state.object!r}: "
+            f"{orm_execute_state.statement}")
@@ -9,10 +9,67 @@ from flask import current_app, url_for
 import jwt
 import sqlalchemy as sa
 from sqlalchemy import orm as so
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
 
-from api.app import db
+from api.app import db, cache, activity
 from api.dates import naive_utcnow
+from api.passwords import hash_password, check_password, needs_rehash
+
+class days_until(sa.sql.functions.GenericFunction):
+    """SQL number of whole days from now (UTC) until a datetime column."""
+    type = sa.Integer()
+    inherit_cache = True
+
+
+@compiles(days_until, 'sqlite')
+def compile_days_until_sqlite(element, compiler, **kw):
+    return "CAST(julianday(%s) - julianday('now') AS INTEGER)" % \
+        compiler.process(element.clauses, **kw)
+
+
+@compiles(days_until, 'mysql')
+@compiles(days_until, 'mariadb')
+def compile_days_until_mysql(element, compiler, **kw):
+    return "TIMESTAMPDIFF(DAY, UTC_TIMESTAMP(), %s)" % \
+        compiler.process(element.clauses, **kw)
+
+
+@compiles(days_until)
+def compile_days_until(element, compiler, **kw):
+    return "EXTRACT(DAY FROM %s - (now() AT TIME ZONE 'utc'))" % \
+        compiler.process(element.clauses, **kw)
+
+
+def in_chunks(model, where, apply, chunk_size=1000, progress=None):
+    """Run a set-based statement on the rows matching `where`, a chunk of
+    primary keys at a time, committing after each chunk.
+
+    Args:
+        where (list): Filters of the rows to process
+        apply (Callable): Receives the ids of a chunk and executes the
+            UPDATE or DELETE statements for them
+        progress (Callable): Receives the number of rows processed so far
+            after each chunk
+
+    Returns:
+        int: The number of rows processed
+    """
+    done = last_id = 0
+    while True:
+        ids = db.session.scalars(
+            sa.select(model.id).where(*where, model.id > last_id)
+            .order_by(model.id).limit(chunk_size)).all()
+        if not ids:
+            return done
+        apply(ids)
+        db.session.commit()
+        done += len(ids)
+        last_id = ids[-1]
+        if progress is not None:
+            progress(done)
+
 
 class Updateable:
     def update(self, data):
@@ -25,6 +82,15 @@ class BaseModel(db.Model):
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=naive_utcnow)
 
+    @property
+    def cache_tag(self):
+        """The cache tag of the responses that show this row."""
+        return f'{self.__tablename__}:{self.id}'
+
+    def changed_tags(self):
+        """The cache tags invalidated when this row is written."""
+        return [self.cache_tag]
+
 
 order_products = sa.Table(
     'order_products',
@@ -41,7 +107,7 @@ class Token(BaseModel):
     access_token: so.Mapped[str] = so.mapped_column(sa.String(64), index=True)
     access_expiration: so.Mapped[datetime]
     refresh_token: so.Mapped[str] = so.mapped_column(sa.String(64), index=True)
-    refresh_expiration: so.Mapped[datetime]
+    refresh_expiration: so.Mapped[datetime] = so.mapped_column(index=True)
     user_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey('users.id', ondelete='CASCADE'), index=True)
 
@@ -50,8 +116,13 @@ class Token(BaseModel):
 
     @property
     def access_token_jwt(self):
-        return jwt.encode({'token': self.access_token},
-                          current_app.config.get('SECRET_KEY'),
+        payload = {'token': self.access_token}
+        if current_app.config.get('STATELESS_ACCESS_TOKENS'):
+            # Enough to authenticate requests without reading this row
+            payload.update(
+                uid=self.user_id or self.user.id, role=self.user.role,
+                exp=self.access_expiration.replace(tzinfo=timezone.utc))
+        return jwt.encode(payload, current_app.config.get('SECRET_KEY'),
                           algorithm='HS256')
 
     def generate(self):
@@ -62,45 +133,75 @@ class Token(BaseModel):
         self.refresh_expiration = naive_utcnow() + \
             timedelta(days=current_app.config.get('REFRESH_TOKEN_DAYS'))
 
+    def changed_tags(self):
+        # Tokens are never part of cached responses
+        return []
+
     def expire(self, delay=None):
         if delay is None:  # pragma: no branch
             # 5 second delay to allow simultaneous requests
             delay = 5 if not current_app.testing else 0
         self.access_expiration = naive_utcnow() + timedelta(seconds=delay)
         self.refresh_expiration = naive_utcnow() + timedelta(seconds=delay)
-
-    from datetime import timedelta
+        Token.revoke(self.access_token, at=time() + delay)
 
     @staticmethod
-    def clean():
-        """Remove any tokens that have been expired for more than a day."""
-        yesterday = naive_utcnow() - timedelta(days=1)
-
-        # Query all expired tokens
-        expired_tokens = db.session.query(Token).filter(Token.refresh_expiration < yesterday).all()
-
-        # Delete each expired token
-        for token in expired_tokens:
-            db.session.delete(token)
+    def revoke(*access_tokens, at=None):
+        """Drop access tokens from the workers' token caches, and deny-list
+        stateless ones from the given epoch time, once the current
+        transaction commits."""
+        at = time() if at is None else at
+        revoked = db.session.info.setdefault('revoked_tokens', {})
+        for access_token in access_tokens:
+            revoked[access_token] = min(revoked.get(access_token, at), at)
 
-        # Commit the changes to the database
-        db.session.commit()
+    @staticmethod
+    def clean(chunk_size=1000):
+        """Remove any tokens that have been expired for more than a day,
+        a chunk per DELETE so that logins are never blocked for long.
 
+        Returns:
+            int: The number of tokens removed
+        """
+        yesterday = naive_utcnow() - timedelta(days=1)
+        return in_chunks(
+            Token, [Token.refresh_expiration < yesterday],
+            lambda ids: db.session.execute(
+                sa.delete(Token).where(Token.id.in_(ids))
+                .execution_options(synchronize_session=False)),
+            chunk_size)
 
     @staticmethod
-    def from_jwt(access_token_jwt):
+    def claims(access_token_jwt, verify_exp=False):
+        """Return the claims of an access token JWT, or None.
+
+        Expiration is only checked on request, the refresh and revoke
+        endpoints accept expired access tokens.
+        """
         try:
-            access_token = jwt.decode(
+            return jwt.decode(
                 access_token_jwt,
                 current_app.config.get('SECRET_KEY'),
-                algorithms=['HS256']
-            )['token']
-            token = db.session.query(Token).filter_by(access_token=access_token).first()
-            return token
+                algorithms=['HS256'],
+                options={'verify_exp': verify_exp}
+            )
         except jwt.PyJWTError as e:
             print("JWT decoding error:", e)  # Debugging
             return None
 
+    @staticmethod
+    def decode_jwt(access_token_jwt):
+        """Return the access token carried by a JWT, or None."""
+        claims = Token.claims(access_token_jwt)
+        return claims.get('token') if claims else None
+
+    @staticmethod
+    def from_jwt(access_token_jwt):
+        access_token = Token.decode_jwt(access_token_jwt)
+        if access_token is None:
+            return None
+        return db.session.query(Token).filter_by(access_token=access_token).first()
+
 
 class User(Updateable, BaseModel):
     """Customers' profile table"""
@@ -109,8 +210,10 @@ class User(Updateable, BaseModel):
     first_name: so.Mapped[str] = so.mapped_column(sa.String(50))
     last_name: so.Mapped[str] = so.mapped_column(sa.String(50))
     username: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64), unique=True, index=True)
-    email: so.Mapped[str] = so.mapped_column(sa.String(150))
+    email: so.Mapped[str] = so.mapped_column(sa.String(150), index=True)
     date_joined: so.Mapped[datetime] = so.mapped_column(index=True, default= lambda: datetime.now(timezone.utc))
+    # Written in batches from the workers' activity buffers, see ping()
+    last_seen: so.Mapped[Optional[datetime]]
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(250))
     # Tokens should have passive deletes
     tokens: so.Mapped['Token'] = so.relationship(
@@ -121,6 +224,9 @@ class User(Updateable, BaseModel):
 
     cart_items: so.Mapped[List['Cart']] = so.relationship('Cart', back_populates='customer', lazy='select', cascade='all, delete-orphan')
 
+    # Filled in by the loader profiles of user lists, see api/loaders.py
+    _cart_size: so.Mapped[Optional[int]] = so.query_expression()
+
     @property
     def url(self):
         return url_for('users.get', id=self.id)
@@ -134,7 +240,10 @@ class User(Updateable, BaseModel):
 
     @property
     def cart_size(self):
-        return len(db.session.get(User, self.id).cart_items)
+        if self._cart_size is not None:
+            return self._cart_size
+        return db.session.scalar(
+            sa.select(sa.func.count()).where(Cart.customer_id == self.id))
 
     @property
     def has_password(self):
@@ -148,14 +257,42 @@ class User(Updateable, BaseModel):
     def password(self, password):
         if not password:
             raise ValueError('Password can not be empty!')
-        self.password_hash = generate_password_hash(password=password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check a password, upgrading its hash to the configured method
+        when it matches. The new hash is saved with the caller's commit."""
+        if not self.password_hash or \
+                not check_password(self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            self.password = password
+        return True
 
 
     def ping(self):
-        self.last_seen = naive_utcnow()
+        """Record that the user was seen now, to be saved by the
+        save_activity task."""
+        activity.touch(self.id, naive_utcnow())
+
+    @staticmethod
+    def save_activity(seen):
+        """Write the last seen times of many users in one executemany
+        UPDATE, never moving a time backwards.
+
+        Args:
+            seen (dict): The last seen time by user id
+        """
+        if not seen:
+            return
+        db.session.execute(
+            sa.update(User.__table__)
+            .where(User.id == sa.bindparam('user_id'))
+            .where(sa.or_(User.last_seen.is_(None),
+                          User.last_seen < sa.bindparam('seen')))
+            .values(last_seen=sa.bindparam('seen')),
+            [{'user_id': id, 'seen': when} for id, when in seen.items()])
+        db.session.commit()
 
     def generate_auth_token(self):
         token = Token(user=self)
@@ -164,15 +301,46 @@ class User(Updateable, BaseModel):
 
     @staticmethod
     def verify_access_token(access_token_jwt, refresh_token=None):
-        token = Token.from_jwt(access_token_jwt)
+        stateless = current_app.config.get('STATELESS_ACCESS_TOKENS')
+        claims = Token.claims(access_token_jwt, verify_exp=stateless)
+        access_token = claims.get('token') if claims else None
+        if access_token is None:
+            return None
+        if stateless and 'uid' in claims:
+            denied = cache.is_denied(access_token) if cache is not None \
+                else None
+            if denied:
+                return None
+            if denied is not None:
+                # Without redis to check the deny-list, fall back to the
+                # tokens table
+                return User.token_user(claims['uid'])
+        if cache is not None:
+            verified = cache.verified_token(access_token)
+            if verified is not None:
+                return User.token_user(verified[0])
+        token = db.session.query(Token).filter_by(access_token=access_token).first()
         if token:
-            if token.access_expiration > naive_utcnow():
+            now = naive_utcnow()
+            if token.access_expiration > now:
                 token.user.ping()
-                db.session.commit()
+                if cache is not None:
+                    cache.remember_token(
+                        access_token, token.user.id, token.user.role,
+                        (token.access_expiration - now).total_seconds())
                 return token.user
         return None
 
 
+    @staticmethod
+    def token_user(user_id):
+        """Return the user of an access token verified without the tokens
+        table, or None when the user has been deleted since."""
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user.ping()
+        return user
+
     @staticmethod
     def verify_refresh_token(refresh_token, access_token_jwt):
         token = Token.from_jwt(access_token_jwt)
@@ -186,7 +354,9 @@ class User(Updateable, BaseModel):
             db.session.commit()
 
     def revoke_all(self):
-        db.session.execute(Token.delete().where(Token.user == self))
+        Token.revoke(*db.session.scalars(
+            sa.select(Token.access_token).where(Token.user_id == self.id)))
+        db.session.execute(sa.delete(Token).where(Token.user_id == self.id))
 
     def generate_reset_token(self):
         return jwt.encode(
@@ -238,7 +408,9 @@ class Product(Updateable, BaseModel):
     artist_name: so.Mapped[str] = so.mapped_column(sa.String(256), nullable=False)
     goal: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False)
     deadline: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False)
+    # No longer read, expires_at holds the deadline
     _days_left: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=True)
+    expires_at: so.Mapped[Optional[datetime]] = so.mapped_column(index=True)
     expire: so.Mapped[Optional[bool]] = so.mapped_column(sa.Boolean, default=False)
     # mainImage: so.Mapped[Optional[str]] = so.mapped_column(sa.String(500))
     subImages: so.Mapped[Optional[List[str]]] = so.mapped_column(sa.JSON)
@@ -257,30 +429,40 @@ class Product(Updateable, BaseModel):
 
     cart_items = so.relationship('Cart', back_populates='product', lazy='select', cascade='all, delete-orphan')
 
-    @property
+    __table_args__ = (
+        # Listings of active products, newest first
+        sa.Index('ix_products_expire_timestamp', 'expire', 'timestamp'),
+    )
+
+    @hybrid_property
     def days_left(self) -> int:
         """
         Calculate the number of days left from the deadline.
 
         return: int, days remaining
         """
-        if self._days_left is not None:
-            return self._days_left
-
-        # Calculate the deadline date
-        deadline_date = self.timestamp + timedelta(days=self.deadline)
-        today = datetime.now()
-        days_remaining = (deadline_date - today).days
+        expires_at = self.expires_at
+        if expires_at is None:
+            # Not flushed yet
+            expires_at = (self.timestamp or naive_utcnow()) + \
+                timedelta(days=self.deadline)
+        days_remaining = (expires_at - naive_utcnow()).days
 
         # Ensure the days remaining is not negative
         return max(0, days_remaining)
 
-    @days_left.setter
-    def days_left(self, value: int):
+    @days_left.inplace.expression
+    @classmethod
+    def _days_left_expression(cls):
+        days = days_until(cls.expires_at)
+        return sa.case((days < 0, 0), else_=days)
+
+    @days_left.inplace.setter
+    def _days_left_setter(self, value: int):
         if not isinstance(value, int):
             raise ValueError("Days left must be a number")
 
-        self._days_left = value
+        self.expires_at = naive_utcnow() + timedelta(days=value)
 
         # Set expire only when days_left is 0
         if value == 0:
@@ -291,6 +473,101 @@ class Product(Updateable, BaseModel):
         if self.days_left == 0:
             self.expire = True
 
+    @staticmethod
+    def expire_due(now=None, chunk_size=1000):
+        """Flag the products past their deadline as expired, found with the
+        expires_at index, a chunk per UPDATE.
+
+        Returns:
+            list: The ids of the products expired
+        """
+        expired = []
+
+        def expire(ids):
+            db.session.execute(
+                sa.update(Product).where(Product.id.in_(ids))
+                .values(expire=True)
+                .execution_options(synchronize_session=False))
+            expired.extend(ids)
+
+        in_chunks(
+            Product, [Product.expires_at <= (now or naive_utcnow()),
+                      Product.expire.is_not(True)],
+            expire, chunk_size)
+        return expired
+
+    @staticmethod
+    def filters(artist=None, color=None, created_before=None):
+        """Return the where clauses selecting products for bulk actions."""
+        where = []
+        if artist is not None:
+            where.append(Product.artist_name == artist)
+        if color is not None:
+            where.append(Product.color == color)
+        if created_before is not None:
+            where.append(Product.timestamp < created_before)
+        return where
+
+    @staticmethod
+    def bulk_expire(where, chunk_size=1000, progress=None):
+        """Expire the matching products now, a chunk per UPDATE.
+
+        Returns:
+            int: The number of products expired
+        """
+        now = naive_utcnow()
+        return in_chunks(
+            Product, [*where, Product.expire.is_not(True)],
+            lambda ids: db.session.execute(
+                sa.update(Product).where(Product.id.in_(ids))
+                .values(expire=True, expires_at=now)
+                .execution_options(synchronize_session=False)),
+            chunk_size, progress)
+
+    @staticmethod
+    def bulk_delete(where, chunk_size=1000, progress=None):
+        """Delete the matching products, with their cart items and order
+        lines, a chunk per DELETE.
+
+        Returns:
+            int: The number of products deleted
+        """
+        def delete(ids):
+            # Done here rather than by ON DELETE CASCADE, which SQLite
+            # only enforces with foreign keys enabled
+            db.session.execute(
+                sa.delete(Cart).where(Cart.product_id.in_(ids))
+                .execution_options(synchronize_session=False))
+            db.session.execute(
+                order_products.delete()
+                .where(order_products.c.product_id.in_(ids)))
+            db.session.execute(
+                sa.delete(Product).where(Product.id.in_(ids))
+                .execution_options(synchronize_session=False))
+
+        return in_chunks(Product, where, delete, chunk_size, progress)
+
+    @staticmethod
+    def backfill_expires_at(chunk_size=1000):
+        """Compute expires_at for the products created before it existed.
+
+        Returns:
+            int: The number of products updated
+        """
+        count = 0
+        while True:
+            rows = db.session.execute(
+                sa.select(Product.id, Product.timestamp, Product.deadline)
+                .where(Product.expires_at.is_(None))
+                .limit(chunk_size)).all()
+            if not rows:
+                return count
+            db.session.execute(sa.update(Product), [
+                {'id': id, 'expires_at': timestamp + timedelta(days=deadline)}
+                for id, timestamp, deadline in rows])
+            db.session.commit()
+            count += len(rows)
+
     @property
     def artist_details(self):
         return self.artist.description
@@ -344,5 +621,128 @@ class Cart(BaseModel):
     customer: so.Mapped['User'] = so.relationship('User',back_populates='cart_items', lazy='joined')
     product: so.Mapped['Product'] = so.relationship('Product', back_populates='cart_items', lazy='joined')
 
+    # A product of a given size is a single item of a cart, see add()
+    __table_args__ = (
+        sa.UniqueConstraint('customer_id', 'product_id', 'size',
+                            name='uq_carts_customer_product_size'),
+    )
+
+    def changed_tags(self):
+        # The cart size is part of the user's responses
+        return [self.cache_tag, f'cart:{self.customer_id}']
+
+    @staticmethod
+    def add(customer_id, product_id, size, quantity=1):
+        """Add to the quantity of a cart item, creating it when missing, in
+        a single INSERT ... ON CONFLICT (ON DUPLICATE KEY on MySQL) UPDATE
+        statement, so that concurrent additions are never lost."""
+        values = dict(customer_id=customer_id, product_id=product_id,
+                      size=size, quantity=quantity)
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('mysql', 'mariadb'):
+            statement = mysql.insert(Cart).values(**values)
+            statement = statement.on_duplicate_key_update(
+                quantity=Cart.quantity + statement.inserted.quantity)
+        else:
+            insert = postgresql.insert if dialect == 'postgresql' \
+                else sqlite.insert
+            statement = insert(Cart).values(**values)
+            statement = statement.on_conflict_do_update(
+                index_elements=['customer_id', 'product_id', 'size'],
+                set_={'quantity': Cart.quantity + statement.excluded.quantity})
+        db.session.execute(statement)
+
+    @staticmethod
+    def remove(id, quantity=1):
+        """Subtract from the quantity of a cart item in the database, and
+        delete the item when none is left, in the same transaction.
+
+        Returns:
+            bool: Whether the item was deleted
+        """
+        db.session.execute(
+            sa.update(Cart).where(Cart.id == id)
+            .values(quantity=Cart.quantity - quantity)
+            .execution_options(synchronize_session=False))
+        return db.session.execute(
+            sa.delete(Cart).where(Cart.id == id, Cart.quantity <= 0)
+            .execution_options(synchronize_session=False)).rowcount > 0
+
+    @staticmethod
+    def total(customer_id):
+        """The price of all the items in a customer's cart."""
+        return db.session.scalar(
+            sa.select(sa.func.coalesce(
+                sa.func.sum(Cart.quantity * Product.price), 0))
+            .join(Cart.product).where(Cart.customer_id == customer_id))
+
     def __repr__(self):
-        return '<Cart {}>'.format(self.id)
\ No newline at end of file
+        return '<Cart {}>'.format(self.id)
+
+
+@sa.event.listens_for(so.Session, 'after_flush')
+def collect_changed_tags(session, flush_context):
+    """Remember the cache tags of the rows written by a flush."""
+    if cache is None:
+        return
+    tags = session.info.setdefault('changed_tags', set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, BaseModel) and (
+                obj not in session.dirty or
+                session.is_modified(obj, include_collections=False)):
+            tags.update(obj.changed_tags())
+
+
+@sa.event.listens_for(so.Session, 'after_commit')
+def invalidate_changed_tags(session):
+    """Invalidate the cached entities of the rows a commit wrote."""
+    tags = session.info.pop('changed_tags', None)
+    if tags:
+        cache.invalidate(*tags)
+
+
+@sa.event.listens_for(so.Session, 'after_commit')
+def broadcast_revoked_tokens(session):
+    """Drop the access tokens a commit revoked from every worker."""
+    revoked = session.info.pop('revoked_tokens', None)
+    if revoked and cache is not None:
+        deny_for = None
+        if current_app.config.get('STATELESS_ACCESS_TOKENS'):
+            # A revoked token can't outlive its expiration
+            deny_for = current_app.config['ACCESS_TOKEN_MINUTES'] * 60
+        cache.revoke_tokens(revoked, deny_for)
+
+
+@sa.event.listens_for(Token, 'before_delete')
+def revoke_deleted_token(mapper, connection, token):
+    """Revoke the access token of a token row the session deletes, be it
+    explicitly or as the orphan replaced by a new login."""
+    Token.revoke(token.access_token)
+
+
+@sa.event.listens_for(User.role, 'set')
+def revoke_cached_role(user, value, oldvalue, initiator):
+    """Make the workers verify the user's tokens again to see a new role."""
+    if user.id is not None and value != oldvalue:
+        with db.session.no_autoflush:
+            Token.revoke(*db.session.scalars(
+                sa.select(Token.access_token).where(Token.user_id == user.id)))
+
+
+@sa.event.listens_for(so.Session, 'after_rollback')
+def discard_changed_tags(session):
+    session.info.pop('changed_tags', None)
+    session.info.pop('revoked_tokens', None)
+
+
+@sa.event.listens_for(Product, 'before_insert')
+@sa.event.listens_for(Product, 'before_update')
+def set_expires_at(mapper, connection, product):
+    """Keep expires_at in step with the product's deadline."""
+    if product.expires_at is None or (
+            so.attributes.get_history(product, 'deadline').has_changes() and
+            not so.attributes.get_history(product, 'expires_at').has_changes()):
+        if product.timestamp is None:
+            product.timestamp = naive_utcnow()
+        product.expires_at = product.timestamp + \
+            timedelta(days=product.deadline)
@@ -6,6 +6,7 @@ from api.app import cache
 from api.app import endpoint_secret
 from api.auth import token_auth, role_required
 from api.decorators import paginated_response
+from api import loaders
 from api.models import Order, Cart
 from api.schemas import OrderSchema, DateTimePaginationSchema
 from api.utilities import handle_failed_payment, handle_successful_payment
@@ -20,7 +21,10 @@ update_orders_schema = OrderSchema(partial=True)
 
 @orders_bp.route('/orders', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@paginated_response(schema=order_schema, pagination_schema=DateTimePaginationSchema, order_by=Order.timestamp, order_direction='desc')
+@paginated_response(schema=order_schema, pagination_schema=DateTimePaginationSchema, order_by=Order.timestamp, order_direction='desc',
+                    cache_tags=('orders', 'products', 'artists', 'users', 'carts'),
+                    scope='role', total_mode='cached',
+                    loader=loaders.ORDERS)
 @role_required('admin')
 def get_orders():
     """Return paginated list of orders"""
@@ -36,7 +40,7 @@ def delete_orders(id):
     db.session.delete(order)
     db.session.commit()
     if cache is not None:
-        cache.flush() # Clear the cache. # Clear the cache.
+        cache.invalidate('orders')
 
     return {}
 
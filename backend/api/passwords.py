@@ -0,0 +1,66 @@
+"""
+Password hashing.
+
+Hashes are computed in the request thread. With threaded workers, e.g.
+gunicorn's gthread class, a semaphore shared by the threads of a worker lets
+only PASSWORD_HASH_WORKERS of them hash at once, the others waiting their
+turn, which bounds how many cores a burst of logins can take from other
+requests, hashlib releasing the GIL while hashing. The sync workers started
+by boot.sh serve one request at a time, so the bound never applies there,
+their number already caps the concurrent hashes. Each hash records the
+method and parameters it was made with, so that the hashes of an older
+PASSWORD_HASH_METHOD are upgraded when their user next logs in.
+"""
+from functools import lru_cache
+import os
+import threading
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+_semaphore = None
+_pid = None
+_lock = threading.Lock()
+
+
+def _run(f, *args, **kwargs):
+    """Runs f once one of this worker's hashing slots is free, or right
+    away without a limit."""
+    global _semaphore, _pid
+    workers = current_app.config.get('PASSWORD_HASH_WORKERS')
+    if not workers:
+        return f(*args, **kwargs)
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                # A fork may copy a slot held by another thread
+                _semaphore = threading.BoundedSemaphore(workers)
+                _pid = os.getpid()
+    with _semaphore:
+        return f(*args, **kwargs)
+
+
+@lru_cache
+def hash_version(method):
+    """Returns the prefix of the hashes made with a method, e.g.
+    'scrypt:32768:8:1' for 'scrypt'."""
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def hash_password(password):
+    """Returns the hash of a password, made with PASSWORD_HASH_METHOD."""
+    return _run(generate_password_hash, password,
+                method=current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def check_password(password_hash, password):
+    """Returns whether a password matches its hash."""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Returns whether a hash was made with other than the configured
+    method and parameters."""
+    version = password_hash.split('$', 1)[0]
+    return version != hash_version(
+        current_app.config['PASSWORD_HASH_METHOD'])
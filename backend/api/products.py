@@ -1,22 +1,30 @@
 import os
+import json
+import sqlalchemy as sa
 from uuid import uuid4
 from marshmallow import ValidationError
 from flask import Blueprint, abort, current_app, send_from_directory
 from werkzeug.utils import secure_filename
-from apifairy import authenticate, body, response, other_responses
+from apifairy import arguments, authenticate, body, response, \
+    other_responses
 
 from api import db
-from api.app import cache
-from api.limiter import limiter
+from api.app import cache, scheduler
+from api.limiter import limit_blueprint
 from api.auth import token_auth, role_required
 from api.models import Product, Artist, Cart
-from api.schemas import ProductSchema
-from api.decorators import paginated_response
-from api.schemas import DateTimePaginationSchema
+from api.schemas import ProductSchema, ProductIdsSchema, \
+    ProductIdsQuerySchema, ProductBatchSchema, ProductFilterSchema
+from api.decorators import paginated_response, entity_response, \
+    entity_bodies
+from api import loaders
+from api.schemas import DateTimePaginationSchema, ProductPaginationSchema
 from api.errors import validation_error
 from api.utilities import allowed_file
+from api.uniqueness import unique_violations
 
 products_bp = Blueprint('products', __name__)
+limit_blueprint(products_bp)
 product_schema = ProductSchema()
 products_schema = ProductSchema(many=True)
 update_product_schema = ProductSchema(partial=True)
@@ -38,8 +46,9 @@ def new_sweater(data):
     sub_images = data.get('subImages')
     title = data.get('title')
 
-    if db.session.query(Product).filter_by(title=title).first():
-        return abort(400, description="This product title already exists, try another!")
+    errors = unique_violations(Product, {'title': title})
+    if errors:
+        return abort(400, description=errors['title'][0])
 
     if not sub_images:
         abort(400, description="Missing subImages.")
@@ -92,7 +101,7 @@ def new_sweater(data):
         db.session.add(product)
         db.session.commit()
         if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+            cache.invalidate('products')
 
     except IOError as io_err:
         db.session.rollback()
@@ -194,7 +203,7 @@ def update_product(data, id):
         product.update(data)
         db.session.commit()
         if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+            cache.invalidate('products')
 
     except IOError as io_err:
         db.session.rollback()
@@ -214,8 +223,13 @@ def update_product(data, id):
     return product
 
 
+def artist_tags(product):
+    """Products show their artist's details."""
+    return [f'artists:{product.artist_id}']
+
+
 @products_bp.route('/sales/<int:id>', methods=['GET'], strict_slashes=False)
-@response(product_schema)
+@entity_response(product_schema, Product, depends_on=artist_tags)
 @other_responses({404: 'Products not found'})
 def get_product(id):
     """Get product sales
@@ -235,21 +249,67 @@ def get_product(id):
     return product
 
 
+def batch_response(ids):
+    """Return the products with the given ids in their order, and the ids
+    without a product."""
+    ids = list(dict.fromkeys(ids))
+    bodies = entity_bodies(product_schema, Product, ids,
+                           depends_on=artist_tags)
+    missing = [id for id in ids if id not in bodies]
+    # Cached bodies are joined as is, without decoding them
+    body = b'{"data":[' + b','.join(bodies[id] for id in ids if id in bodies) \
+        + b'],"missing":' + json.dumps(missing).encode() + b'}'
+    return current_app.response_class(body, mimetype='application/json')
+
+
+@products_bp.route('/products/batch', methods=['GET'], strict_slashes=False)
+@arguments(ProductIdsQuerySchema)
+@other_responses({200: (ProductBatchSchema, 'The requested products')})
+def get_products_batch(args):
+    """Get several products
+
+    Returns the products whose ids are given as a comma separated `ids`
+    argument, in the same order, and lists the ids that do not exist
+    under `missing`.
+    """
+    return batch_response(args['ids'])
+
+
+@products_bp.route('/products/batch', methods=['POST'], strict_slashes=False)
+@body(ProductIdsSchema)
+@other_responses({200: (ProductBatchSchema, 'The requested products')})
+def post_products_batch(args):
+    """Get several products
+
+    Same as the GET variant, for lists of ids too long for a URL.
+    """
+    return batch_response(args['ids'])
+
+
 @products_bp.route('/products', methods=['GET'], strict_slashes=False)
-@limiter.limit("1 per day")
 @paginated_response(products_schema, order_by=Product.timestamp,
                     order_direction='desc',
-                    pagination_schema=DateTimePaginationSchema)
-def all_products():
-    """Retrieves all products"""
-    return db.session.query(Product)
+                    pagination_schema=ProductPaginationSchema,
+                    cache_tags=('products', 'artists'), stale_ttl=10,
+                    loader=loaders.PRODUCTS)
+def all_products(active=None):
+    """Retrieves all products
+
+    Pass `active=true` to only list the products that have not expired.
+    """
+    query = db.session.query(Product)
+    if active is not None:
+        query = query.filter(Product.expire == (not active))
+    return query
 
 
 @products_bp.route('/artists/<name>/products', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
 @paginated_response(products_schema, order_by=Product.timestamp,
                     order_direction='desc',
-                    pagination_schema=DateTimePaginationSchema)
+                    pagination_schema=DateTimePaginationSchema,
+                    cache_tags=('products', 'artists'),
+                    loader=loaders.PRODUCTS)
 @other_responses({404: 'Artist not found'})
 def all_user_product(name):
     """Retrieves all products by an artist"""
@@ -267,41 +327,39 @@ def delete_product(id):
     db.session.delete(product)
     db.session.commit()
     if cache is not None:
-            cache.flush() # Clear the cache. # Clear the cache.
+        cache.invalidate('products')
     return {}, 204
 
 
 @products_bp.route('/products-all', methods=['DELETE'], strict_slashes=False)
 @authenticate(token_auth)
 @role_required('admin')
+@arguments(ProductFilterSchema)
 @other_responses({403: 'Action denied', 404: 'Product not found'})
-def delete_all_products() -> None:
+def delete_all_products(args) -> None:
     """Delete all products
-    """
-    products = db.session.query(Product).all() or abort(404)
-    for product in products:
-        db.session.delete(product)
-        db.session.commit()
-    if cache is not None:
-            cache.flush() # Clear the cache.
 
+    The query string arguments restrict the deletion to the products of an
+    artist, of a color or created before a date.
+    """
+    bulk_delete_products(**args) or abort(404)
     return {}, 204
 
 @products_bp.route('/products-all', methods=['PUT'], strict_slashes=False)
 @authenticate(token_auth)
 @role_required('admin')
+@arguments(ProductFilterSchema)
 @other_responses({403: 'Action denied', 404: 'Product not found'})
-def expire_all_products() -> None:
+def expire_all_products(args) -> None:
     """Expires all products
-    """
-    products = db.session.query(Product).all() or abort(404)
-    for product in products:
-        product.days_left = 0
-        product.update_expiration_status()
-        db.session.commit()
-    if cache is not None:
-            cache.flush() # Clear the cache.
 
+    The query string arguments restrict the expiration to the products of an
+    artist, of a color or created before a date.
+    """
+    if not bulk_expire_products(**args) and db.session.scalar(
+            sa.select(Product.id).where(*Product.filters(**args))
+            .limit(1)) is None:
+        abort(404)
     return {}, 204
 
 @products_bp.route('/expire/<int:id>', methods=['PUT'], strict_slashes=False)
@@ -317,6 +375,55 @@ def expire_product(id) -> None:
         product.update_expiration_status()
     db.session.commit()
     if cache is not None:
-            cache.flush() # Clear the cache.
+        cache.invalidate('products')
+
+    return {}, 204
+
+
+@scheduler.task('expire_products', 'PRODUCT_EXPIRY_INTERVAL')
+def expire_due_products():
+    """Flag the products past their deadline as expired"""
+    chunk_size = current_app.config['BULK_CHUNK_SIZE']
+    Product.backfill_expires_at(chunk_size)
+    ids = Product.expire_due(chunk_size=chunk_size)
+    if ids and cache is not None:
+        cache.invalidate('products', *[f'products:{id}' for id in ids])
+
+
+def bulk_progress(action):
+    """Return a progress callback logging the rows processed so far."""
+    def progress(done):
+        current_app.logger.info('%s %d products', action, done)
+    return progress
 
-    return {}, 204
\ No newline at end of file
+
+def bulk_expire_products(progress=None, **filters):
+    """Expire the products matching the filters, chunk by chunk, and
+    invalidate the cache once at the end.
+
+    Returns:
+        int: The number of products expired
+    """
+    count = Product.bulk_expire(
+        Product.filters(**filters), current_app.config['BULK_CHUNK_SIZE'],
+        progress or bulk_progress('Expired'))
+    if count and cache is not None:
+        cache.invalidate('products', 'carts', 'orders')
+        cache.flush('entities')
+    return count
+
+
+def bulk_delete_products(progress=None, **filters):
+    """Delete the products matching the filters, chunk by chunk, and
+    invalidate the cache once at the end.
+
+    Returns:
+        int: The number of products deleted
+    """
+    count = Product.bulk_delete(
+        Product.filters(**filters), current_app.config['BULK_CHUNK_SIZE'],
+        progress or bulk_progress('Deleted'))
+    if count and cache is not None:
+        cache.invalidate('products', 'carts', 'orders')
+        cache.flush('entities')
+    return count
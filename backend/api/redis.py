@@ -2,146 +2,836 @@
 """
 Solutions to redis-python exercises
 """
-from typing import Union, Callable, Any
-from datetime import datetime as dt
+from typing import Callable, Any, Iterable, Optional
+from collections import OrderedDict
 from redis import ConnectionPool
 from functools import wraps
 from redis import Redis
-from uuid import uuid4
+from redis.lock import Lock
+from flask import has_request_context, request
+from api.codecs import Serializer, compress, GZIP
+import threading
+import random
+import re
+import atexit
+import copy
 import json
+import time
 import os
 
 
 redis_host: str = os.environ.get('REDIS_HOST')
 redis_port: str = os.environ.get('REDIS_PORT')
+local_cache_size: int = int(os.environ.get('CACHE_LOCAL_SIZE') or '0')
+local_cache_ttl: float = float(os.environ.get('CACHE_LOCAL_TTL') or '5')
+lock_timeout: float = float(os.environ.get('CACHE_LOCK_TIMEOUT') or '10')
+lock_wait: float = float(os.environ.get('CACHE_LOCK_WAIT') or '2')
+compress_min_size: int = int(os.environ.get('CACHE_COMPRESS_MIN_SIZE') or '0')
+cache_codec: str = os.environ.get('CACHE_CODEC') or 'json'
+cache_compression: str = os.environ.get('CACHE_COMPRESSION') or 'gzip'
+metrics_interval: float = float(os.environ.get('CACHE_METRICS_INTERVAL') or '10')
+metrics_sample_rate: float = float(os.environ.get('CACHE_METRICS_SAMPLE_RATE') or '0.01')
+metrics_sample_size: int = int(os.environ.get('CACHE_METRICS_SAMPLES') or '100')
+token_cache_size: int = int(os.environ.get('TOKEN_CACHE_SIZE') or '1000')
+token_cache_ttl: float = float(os.environ.get('TOKEN_CACHE_TTL') or '300')
+GZIP_MAGIC = b'\x1f\x8b'
+STATS_KEY = 'cache:stats'
+SAMPLES_KEY = 'cache:samples'
+GENERATIONS_KEY = 'cache:generations'
+# Seconds a worker trusts its copy of the namespace generations
+GENERATION_TTL = 1.0
+NAMESPACES = ('pages', 'entities', 'counts')
+INVALIDATION_CHANNEL = 'cache:invalidate'
+# Seconds between two subscription attempts while pub/sub is down, doubled
+# after each failure
+LISTEN_RETRY = 1.0
+LISTEN_MAX_RETRY = 60.0
+REVOCATION_CHANNEL = 'cache:revoke'
+DENY_LIST_KEY = 'denied:{}'
+# Key segments unique to an entry, such as ids and hex digests
+UNIQUE_SEGMENT = re.compile(r'\d+|[0-9a-f]{16,}')
 
-def count_calls(method: Callable) -> Callable:
-    """Track the number of calls to a redis method.
-
-    Args:
-        method (Callable): The cache function called
+class CacheMetrics:
+    """
+        Bounded cache metrics: hit, miss and set counters per key prefix,
+        latency histograms per operation and a capped log of sampled calls.
 
-    Returns:
-        Callable: The cache function called with its parameters.
+        Each worker aggregates in memory and writes everything to redis in
+        a single pipeline every `interval` seconds, instead of on each call.
     """
-    @wraps(method)
-    def invoker(self, *args, **kwargs) -> Any:
+    # Upper bounds of the latency buckets, in milliseconds
+    BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250)
+    MAX_PREFIXES = 100
+
+    def __init__(self, redis: Redis, interval: float = metrics_interval,
+                 sample_rate: float = metrics_sample_rate,
+                 sample_size: int = metrics_sample_size) -> None:
+        """Instantiates empty metrics.
+
+        Args:
+            interval (float): Seconds between two writes to redis
+            sample_rate (float): Fraction of calls logged with their key
+            sample_size (int): Number of sampled calls kept in redis
         """
-        Invokes the redis cache method, increment its call counter while also preserve the arguments and docstring of the redis cache method.
+        self._redis = redis
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.sample_size = sample_size
+        self._counters = {}
+        self._samples = []
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
 
-        Returns:
-            Any: Response of the original function
+    def prefix(self, key: str) -> str:
+        """Groups keys by dropping generations, ids, digests, the values of
+        unique columns and query strings, e.g.
+        'pages:3:user:5:/api/users/7:{}' -> 'pages:user:/api/users/<int:id>'
+        and 'entities:3:users:username:jane' -> 'entities:users:username'.
         """
-        if isinstance(self._redis, Redis):
-            self._redis.incr(method.__qualname__)
-        return method(self, *args, **kwargs)
-    return invoker
+        namespace, _, rest = key.partition(':')
+        parts = rest.split('{', 1)[0].split(':')
+        if namespace in NAMESPACES and parts[0].isdigit():
+            parts = parts[1:]
+        if namespace == 'entities':
+            # <table>:<column>:<value>[:<fields>]
+            parts = parts[:2]
+        elif namespace == 'counts':
+            # A digest of the counted statement
+            parts = []
+        elif namespace == 'pages':
+            if parts[0] == 'user':
+                parts = parts[:1] + parts[2:]
+            path = ':'.join(part for part in parts if part.startswith('/'))
+            parts = [part for part in parts if not part.startswith('/')]
+            parts.append(self._route(path))
+        prefix = ':'.join([namespace] + [
+            part for part in parts
+            if part and not UNIQUE_SEGMENT.fullmatch(part)])
+        if prefix not in self._prefixes:
+            if len(self._prefixes) >= self.MAX_PREFIXES:
+                return 'other'
+            self._prefixes.add(prefix)
+        return prefix
+
+    @staticmethod
+    def _route(path: str) -> str:
+        """Returns the URL rule of a path, e.g. '/api/users/<int:id>'.
+
+        The rule of the current request is used when it matches the path,
+        other paths have their ids and digests replaced.
+        """
+        if has_request_context() and request.url_rule is not None and \
+                request.path == path:
+            return request.url_rule.rule
+        return '/'.join('<id>' if UNIQUE_SEGMENT.fullmatch(segment)
+                        else segment for segment in path.split('/'))
+
+    def observe(self, operation: str, key: str, seconds: float,
+                outcome: str) -> None:
+        """Records one cache call.
+
+        Args:
+            operation (str): The Cache method, e.g. 'get'
+            key (str): The key it was called with
+            seconds (float): How long the call took
+            outcome (str): 'hits', 'misses' or 'sets'
+        """
+        ms = seconds * 1000
+        bucket = next((str(b) for b in self.BUCKETS if ms <= b), '+Inf')
+        with self._lock:
+            for field in ('prefix|{}|{}'.format(outcome, self.prefix(key)),
+                          'latency|{}|{}'.format(operation, bucket)):
+                self._counters[field] = self._counters.get(field, 0) + 1
+            if random.random() < self.sample_rate:
+                self._samples.append(json.dumps({
+                    'operation': operation, 'key': key, 'outcome': outcome,
+                    'ms': round(ms, 3), 'at': time.time()}))
+                del self._samples[:-self.sample_size]
+        self._maybe_flush()
+
+    def incr(self, counter: str, amount: int = 1) -> None:
+        """Increments a named counter, e.g. 'coalesced'."""
+        field = 'counter|{}'.format(counter)
+        with self._lock:
+            self._counters[field] = self._counters.get(field, 0) + amount
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if time.monotonic() - self._flushed >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the metrics aggregated by this worker to redis."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            samples, self._samples = self._samples, []
+            self._flushed = time.monotonic()
+        if not counters and not samples:
+            return
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for field, amount in counters.items():
+                pipe.hincrby(STATS_KEY, field, amount)
+            if samples:
+                pipe.lpush(SAMPLES_KEY, *samples)
+                pipe.ltrim(SAMPLES_KEY, 0, self.sample_size - 1)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error writing cache metrics: {e}")
+
+    def snapshot(self) -> dict:
+        """Returns the metrics of all workers, as last written to redis."""
+        self.flush()
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hgetall(STATS_KEY)
+        pipe.lrange(SAMPLES_KEY, 0, -1)
+        fields, samples = pipe.execute()
+        prefixes, latency, counters = {}, {}, {}
+        for field, value in fields.items():
+            kind, _, rest = field.partition('|')
+            if kind == 'prefix':
+                outcome, _, prefix = rest.partition('|')
+                prefixes.setdefault(prefix, {'hits': 0, 'misses': 0, 'sets': 0})
+                prefixes[prefix][outcome] = int(value)
+            elif kind == 'latency':
+                operation, _, bucket = rest.partition('|')
+                latency.setdefault(operation, {})[bucket] = int(value)
+            elif kind == 'counter':
+                counters[rest] = int(value)
+        for stats in prefixes.values():
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = round(stats['hits'] / lookups, 4) \
+                if lookups else None
+        order = [str(b) for b in self.BUCKETS] + ['+Inf']
+        latency = {op: {b: buckets[b] for b in order if b in buckets}
+                   for op, buckets in latency.items()}
+        return {
+            'prefixes': prefixes,
+            'latency_ms': latency,
+            'counters': counters,
+            'samples': [json.loads(sample) for sample in samples],
+        }
+
+    def reset(self) -> None:
+        """Clears the metrics of all workers."""
+        with self._lock:
+            self._counters, self._samples = {}, []
+        # Also drop the unbounded call history of previous versions
+        self._redis.delete(STATS_KEY, SAMPLES_KEY, 'Cache.set',
+                           'Cache.set:inputs', 'Cache.set:outputs')
 
-def call_history(method: Callable) -> Callable:
-    """Stores the history of inputs and outputs for a particular function
+
+def measured(operation: str, outcome: Callable) -> Callable:
+    """Records the latency and outcome of a Cache method in its metrics.
 
     Args:
-        method (Callable): a function to decorate
+        operation (str): Name reported for the method
+        outcome (Callable): Maps the method's return value to 'hits',
+            'misses' or 'sets'
 
     Returns:
         Callable: The cache function called with its parameters.
     """
-    @wraps(method)
-    def invoker(self, *args, **kwargs) -> Any:
-        """Invokes the original method
+    def decorator(method: Callable) -> Callable:
+        @wraps(method)
+        def invoker(self, key, *args, **kwargs) -> Any:
+            start = time.perf_counter()
+            output = method(self, key, *args, **kwargs)
+            self.metrics.observe(operation, key, time.perf_counter() - start,
+                                 outcome(output))
+            return output
+        return invoker
+    return decorator
 
-        Returns:
-            Any: Return value of the original method.
-        """
-        input_key = "{}:inputs".format(method.__qualname__)
-        output_key = "{}:outputs".format(method.__qualname__)
-        output = method(self, *args, **kwargs)
-        if isinstance(self._redis, Redis):
-            self._redis.rpush(input_key, str(args))
-            self._redis.rpush(output_key, output)
-        return output
-    return invoker
 
 def replay(fn: Callable) -> None:
-    '''Displays the call history of a Cache class' method.
+    '''Displays the metrics recorded for a Cache class' method.
     '''
     if fn is None or not hasattr(fn, '__self__'):
         return
-    redis_store = getattr(fn.__self__, '_redis', None)
-    if not isinstance(redis_store, Redis):
+    metrics = getattr(fn.__self__, 'metrics', None)
+    if not isinstance(metrics, CacheMetrics):
         return
     fxn_name = fn.__qualname__
-    in_key = '{}:inputs'.format(fxn_name)
-    out_key = '{}:outputs'.format(fxn_name)
-    fxn_call_count = 0
-    if redis_store.exists(fxn_name) != 0:
-        fxn_call_count = int(redis_store.get(fxn_name))
-    print('{} was called {} times:'.format(fxn_name, fxn_call_count))
-    fxn_inputs = redis_store.lrange(in_key, 0, -1)
-    fxn_outputs = redis_store.lrange(out_key, 0, -1)
-    for fxn_input, fxn_output in zip(fxn_inputs, fxn_outputs):
-        print('{}(*{}) -> {}'.format(
-            fxn_name,
-            fxn_input.decode("utf-8"),
-            fxn_output,
-        ))
+    operation = fn.__name__
+    snapshot = metrics.snapshot()
+    buckets = snapshot['latency_ms'].get(operation, {})
+    print('{} was called {} times:'.format(fxn_name, sum(buckets.values())))
+    for prefix, stats in sorted(snapshot['prefixes'].items()):
+        print('  {}: {}'.format(prefix, stats))
+    for bucket, count in buckets.items():
+        print('  <= {} ms: {}'.format(bucket, count))
+    for sample in snapshot['samples']:
+        if sample['operation'] == operation:
+            print('{}({!r}) -> {} in {} ms'.format(
+                fxn_name, sample['key'], sample['outcome'], sample['ms']))
+
+def compress_body(body: bytes, min_size: int = compress_min_size) -> bytes:
+    """Gzips an encoded response body if it is larger than min_size.
+
+    Args:
+        min_size (int): Size in bytes below which bodies are kept as is.
+            Defaults to CACHE_COMPRESS_MIN_SIZE, 0 disables compression.
+    """
+    if min_size and len(body) >= min_size:
+        return compress(body, GZIP)
+    return body
+
+
+def is_compressed(body: bytes) -> bool:
+    """Tells whether a body returned by compress_body() was gzipped."""
+    return body[:2] == GZIP_MAGIC
+
+
+class LocalCache:
+    """
+        A bounded, thread safe LRU cache with a TTL, living in the memory of
+        a single worker process.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        """Instantiates an empty local cache.
+
+        Args:
+            maxsize (int): Maximum number of entries kept
+            ttl (float): Number of seconds an entry is served for
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """Returns the live value stored under key, or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, expire: int = None) -> None:
+        """Stores value under key, evicting the least recently used entries.
+
+        Args:
+            expire (int): Redis TTL of the value, local entries never
+                outlive it
+        """
+        ttl = min(self.ttl, expire) if expire else self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys: str) -> None:
+        """Drops the given keys."""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drops every entry."""
+        with self._lock:
+            self._data.clear()
+
 
 class Cache:
     """
         A redis storage for caching API responses.
+
+        When CACHE_LOCAL_SIZE is set, hot entries are also kept in a per
+        worker LocalCache in front of redis. Writes and invalidations are
+        broadcast over redis pub/sub so every worker drops its local copy.
+
+        Each worker also remembers the access tokens it verified, when
+        TOKEN_CACHE_SIZE is set. Revoked tokens are broadcast the same way.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, local_size: int = local_cache_size,
+                 local_ttl: float = local_cache_ttl,
+                 codec: str = cache_codec,
+                 compression: str = cache_compression,
+                 token_size: int = token_cache_size,
+                 token_ttl: float = token_cache_ttl) -> None:
         """Instantiates the cache object."""
         if os.environ.get('ENV') != 'local':
             pool = ConnectionPool(host=redis_host, port=redis_port, decode_responses=True)
             self._redis = Redis(connection_pool=pool)
+            binary_pool = ConnectionPool(host=redis_host, port=redis_port)
         else:
             pool = ConnectionPool(decode_responses=True)
             self._redis = Redis(connection_pool=pool)
-        self._redis.flushdb(True)
+            binary_pool = ConnectionPool()
+        # Encoded response bodies are read back as bytes
+        self._binary = Redis(connection_pool=binary_pool)
+        self._generations = {}
+        self.metrics = CacheMetrics(self._redis)
+        atexit.register(self.metrics.flush)
+        self._serializer = Serializer(codec, compression, compress_min_size)
+        self._local = LocalCache(local_size, local_ttl) if local_size else None
+        self._tokens = LocalCache(token_size, token_ttl) if token_size else None
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        # (pid, time of the next attempt, delay) after a failed subscription
+        self._listen_retry = None
+
+    def _listen(self) -> None:
+        """Subscribes this worker to invalidation and revocation broadcasts.
+
+        The subscriber thread is started lazily, and again after a fork, so
+        that each gunicorn worker runs its own. When pub/sub is down, the
+        subscription is retried with an exponential backoff, and the local
+        caches are cleared once, when the failure is first seen.
+        """
+        if self._listener_pid == os.getpid():
+            return
+        retry = self._listen_retry
+        if retry is not None and retry[0] == os.getpid() and \
+                time.monotonic() < retry[1]:
+            return
+        handlers = {}
+        if self._local is not None:
+            handlers[INVALIDATION_CHANNEL] = self._on_invalidate
+        if self._tokens is not None:
+            handlers[REVOCATION_CHANNEL] = self._on_revoke
+        if not handlers:
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid() or \
+                    self._listen_retry is not retry:
+                return
+            failing = retry is not None and retry[0] == os.getpid()
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**handlers)
+                self._listener = pubsub.run_in_thread(
+                    sleep_time=1, daemon=True,
+                    exception_handler=self._on_listener_error)
+                self._listener_pid = os.getpid()
+                self._listen_retry = None
+            except Exception as e:
+                print(f"Error subscribing to cache invalidations: {e}")
+                self._retry_listen(failing)
+                if failing:
+                    return
+            # Entries cached before the fork, or while pub/sub was down,
+            # may have missed broadcasts
+            self._clear_local()
+
+    def _listening(self) -> bool:
+        """Subscribes if needed, and returns whether this worker receives
+        the broadcasts, without which its local entries can't be trusted."""
+        self._listen()
+        return self._listener_pid == os.getpid()
 
-    @count_calls
-    @call_history
-    def set(self, key: str, data: str, expire: int = None) -> str:
+    def _retry_listen(self, failing: bool) -> None:
+        """Schedules the next subscription attempt of this worker."""
+        delay = min(self._listen_retry[2] * 2, LISTEN_MAX_RETRY) \
+            if failing else LISTEN_RETRY
+        self._listen_retry = (os.getpid(), time.monotonic() + delay, delay)
+
+    def _on_listener_error(self, error: Exception, pubsub: Any,
+                           thread: Any) -> None:
+        """Stops a subscriber thread that lost its connection, so that the
+        next cache call subscribes again."""
+        print(f"Error listening to cache invalidations: {error}")
+        thread.stop()
+        with self._listener_lock:
+            if self._listener is thread:
+                self._listener_pid = None
+                self._retry_listen(False)
+        self._clear_local()
+
+    def _clear_local(self) -> None:
+        """Drops every entry of the local caches of this worker."""
+        for local in (self._local, self._tokens):
+            if local is not None:
+                local.clear()
+
+    def _on_invalidate(self, message: dict) -> None:
+        """Drops the keys listed in an invalidation broadcast."""
+        keys = json.loads(message['data'])
+        if keys is None:
+            self._local.clear()
+        else:
+            self._local.delete(*keys)
+
+    def _broadcast(self, keys: Optional[list]) -> None:
+        """Tells every worker to drop the given keys, or all keys if None."""
+        if self._local is None:
+            return
+        if keys is None:
+            self._local.clear()
+        else:
+            self._local.delete(*keys)
+        try:
+            self._redis.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+        except Exception as e:
+            print(f"Error broadcasting cache invalidation: {e}")
+
+    def _on_revoke(self, message: dict) -> None:
+        """Forgets the access tokens listed in a revocation broadcast."""
+        self._tokens.delete(*json.loads(message['data']))
+
+    def verified_token(self, access_token: str) -> Optional[tuple]:
+        """Returns the (user id, role) of an access token this worker
+        verified, or None when it has to be checked in the database.
+        """
+        if self._tokens is None or not self._listening():
+            return None
+        return self._tokens.get(access_token)
+
+    def remember_token(self, access_token: str, user_id: int, role: str,
+                       expires_in: float) -> None:
+        """Remembers a verified access token until it expires, or for
+        TOKEN_CACHE_TTL seconds at most.
+        """
+        if self._tokens is not None and expires_in > 0 and self._listening():
+            self._tokens.set(access_token, (user_id, role), expires_in)
+
+    def revoke_tokens(self, revoked: dict, deny_for: int = None) -> None:
+        """Tells every worker to forget the given access tokens.
+
+        Args:
+            revoked: The epoch time each access token is revoked from
+            deny_for (int): When given, the tokens are also deny-listed for
+                that many seconds, see is_denied()
+        """
+        if not revoked:
+            return
+        if deny_for:
+            try:
+                pipe = self._redis.pipeline()
+                for access_token, at in revoked.items():
+                    pipe.set(DENY_LIST_KEY.format(access_token), at,
+                             ex=deny_for)
+                pipe.execute()
+            except Exception as e:
+                print(f"Error deny-listing tokens: {e}")
+        if self._tokens is None:
+            return
+        access_tokens = list(revoked)
+        self._tokens.delete(*access_tokens)
+        try:
+            self._redis.publish(REVOCATION_CHANNEL, json.dumps(access_tokens))
+        except Exception as e:
+            print(f"Error broadcasting token revocation: {e}")
+
+    def is_denied(self, access_token: str) -> Optional[bool]:
+        """Returns whether a stateless access token was revoked, or None
+        when the deny-list can't be read.
+        """
+        try:
+            at = self._redis.get(DENY_LIST_KEY.format(access_token))
+        except Exception as e:
+            print(f"Error reading the token deny-list: {e}")
+            return None
+        return at is not None and float(at) <= time.time()
+
+    def generation(self, namespace: str) -> int:
+        """Returns the current generation of a key namespace.
+
+        Generations are read from redis at most every GENERATION_TTL
+        seconds, so a flush may take that long to reach other workers.
+        """
+        gen, fetched = self._generations.get(namespace, (None, 0))
+        if gen is None or time.monotonic() - fetched > GENERATION_TTL:
+            gen = int(self._redis.hget(GENERATIONS_KEY, namespace) or 0)
+            self._generations[namespace] = (gen, time.monotonic())
+        return gen
+
+    def versioned(self, namespace: str, key: str) -> str:
+        """Prefixes a key with its namespace and current generation.
+
+        Args:
+            namespace (str): One of NAMESPACES, e.g. 'pages'
+            key (str): The key within the namespace
+
+        Returns:
+            str: The redis key to use, e.g. 'pages:3:/api/products:{}'
+        """
+        return '{}:{}:{}'.format(namespace, self.generation(namespace), key)
+
+    @staticmethod
+    def _tag_key(tag: str) -> str:
+        """Returns the redis set holding the keys recorded under a tag."""
+        return 'tag:{}'.format(tag)
+
+    def _queue_set(self, pipe: Any, key: str, data: Any, expire: int,
+                   tags: Optional[Iterable[str]]) -> None:
+        """Adds the commands storing data under key to a pipeline."""
+        if not isinstance(data, bytes):
+            data = self._serializer.encode(data)
+        pipe.set(key, data, ex=expire)
+        for tag in tags or ():
+            tag_key = self._tag_key(tag)
+            pipe.sadd(tag_key, key)
+            if expire:
+                # Keep the tag alive as long as its longest lived entry
+                pipe.expire(tag_key, expire, nx=True)
+                pipe.expire(tag_key, expire, gt=True)
+
+    @measured('set', lambda key: 'sets')
+    def set(self, key: str, data: Any, expire: int = None,
+            tags: Optional[Iterable[str]] = None) -> str:
         """Stores database object into the redis cache
 
         Args:
-            data: Object to cache
+            data: Object to cache. Bytes, such as encoded response bodies,
+                are stored as is, anything else is encoded with the
+                configured codec and read back with get().
+            tags: Entities the cached data depends on, e.g. 'products' or
+                'cart:<user_id>'. The entry is dropped when any of them is
+                invalidated.
 
         Returns:
             str: ID of the object stored
         """
         try:
-            self._redis.set(key, data, ex=expire)
+            pipe = self._redis.pipeline()
+            self._queue_set(pipe, key, data, expire, tags)
+            pipe.execute()
         except Exception as e:
             print(f"Error setting key {key}: {e}")
+        self._broadcast([key])
 
         return key
 
-    def get(self, key: str) -> Union[str, bytes, int, float]:
+    def set_many(self, entries: Iterable[tuple], expire: int = None) -> None:
+        """Stores several values in one round trip
+
+        Args:
+            entries: (key, data, tags) tuples, as passed to set()
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        start = time.perf_counter()
+        try:
+            pipe = self._redis.pipeline()
+            for key, data, tags in entries:
+                self._queue_set(pipe, key, data, expire, tags)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error setting {len(entries)} keys: {e}")
+        self._broadcast([key for key, _, _ in entries])
+        seconds = (time.perf_counter() - start) / len(entries)
+        for key, _, _ in entries:
+            self.metrics.observe('set_many', key, seconds, 'sets')
+
+    @measured('get', lambda value: 'misses' if value is None else 'hits')
+    def get(self, key: str) -> Any:
         """Retrieves the value of a key from the cache
 
         Args:
             key (str): The key whose value we want to retrieve
 
         Returns:
-            Union[str, bytes, int, float]: Possible return types
-        """
-        cache_response = self._redis.get(key)
-
-        if cache_response:
-            cache_response = json.loads(cache_response)
-            data = cache_response.get('data')
-            if data and 'timestamp' in data[0].keys():
-                # Convert the timestamp string to datetime
-                for obj in cache_response['data']:
-                    obj['timestamp'] = dt.fromisoformat(obj['timestamp'])
-        
+            Any: The value stored with set(), decoded by its codec, or None
+        """
+        if self._local is not None:
+            self._listen()
+            cache_response = self._local.get(key)
+            if cache_response is not None:
+                # Callers may annotate the response, keep the local copy intact
+                return copy.copy(cache_response)
+
+        if self._local is not None:
+            # Fetch the TTL in the same round trip to bound the local copy
+            data, ttl = self._binary.pipeline().get(key).ttl(key).execute()
+        else:
+            data = self._binary.get(key)
+
+        if data is None:
+            return None
+        cache_response = self._serializer.decode(data)
+        if self._local is not None:
+            self._local.set(key, cache_response,
+                            expire=ttl if ttl > 0 else None)
+            cache_response = copy.copy(cache_response)
+
         return cache_response
 
-    
-    def flush(self):
-        """Remove all cached data.
+    @measured('get_body', lambda rv: 'misses' if rv[0] is None else 'hits')
+    def get_body(self, key: str) -> tuple:
+        """Retrieves an encoded response body stored with set()
+
+        Args:
+            key (str): The key whose body we want to retrieve
+
+        Returns:
+            tuple: The body as bytes, possibly gzipped, or None, and the
+                number of seconds it has left to live, or None
+        """
+        return self._get_body(key)
+
+    def get_bodies(self, keys: list) -> list:
+        """Retrieves several response bodies stored with set() in one round
+        trip
+
+        Args:
+            keys (list): The keys whose bodies we want to retrieve
+
+        Returns:
+            list: The body of each key, as bytes, or None
+        """
+        start = time.perf_counter()
+        bodies = [None] * len(keys)
+        if self._local is not None:
+            self._listen()
+            for i, key in enumerate(keys):
+                entry = self._local.get(key)
+                if entry is not None:
+                    bodies[i] = entry[0]
+        fetch = [i for i, body in enumerate(bodies) if body is None]
+        if fetch:
+            try:
+                fetched = self._binary.mget([keys[i] for i in fetch])
+            except Exception as e:
+                print(f"Error getting {len(fetch)} keys: {e}")
+                fetched = [None] * len(fetch)
+            for i, body in zip(fetch, fetched):
+                bodies[i] = body
+        seconds = (time.perf_counter() - start) / max(len(keys), 1)
+        for key, body in zip(keys, bodies):
+            self.metrics.observe('get_bodies', key, seconds,
+                                 'misses' if body is None else 'hits')
+        return bodies
+
+    def _get_body(self, key: str) -> tuple:
+        """get_body() without metrics, used when polling a key."""
+        if self._local is not None:
+            self._listen()
+            entry = self._local.get(key)
+            if entry is not None:
+                body, deadline = entry
+                return body, deadline - time.time() if deadline else None
+
+        body, ttl = self._binary.pipeline().get(key).ttl(key).execute()
+        ttl = ttl if ttl > 0 else None
+        if body is not None and self._local is not None:
+            self._local.set(key, (body, time.time() + ttl if ttl else None),
+                            expire=ttl)
+        return body, ttl
+
+    def lock(self, key: str, timeout: float = None) -> Optional[Lock]:
+        """Tries to become the single caller rebuilding a missing key.
+
+        Args:
+            key (str): The cache key about to be rebuilt
+            timeout (float): Seconds after which the lock is released even
+                if its holder never fills the key. Defaults to
+                CACHE_LOCK_TIMEOUT.
+
+        Returns:
+            Optional[Lock]: The acquired lock, or None when another caller
+                is already rebuilding the key
+        """
+        # Not thread local, so that a background thread can release it
+        lock = self._redis.lock('lock:{}'.format(key),
+                                timeout=timeout or lock_timeout,
+                                blocking=False, thread_local=False)
+        return lock if lock.acquire() else None
+
+    def unlock(self, lock: Lock) -> None:
+        """Releases a lock returned by lock()."""
+        try:
+            lock.release()
+        except Exception as e:
+            # The lock expired before the key was filled
+            print(f"Error unlocking {lock.name}: {e}")
+
+    def wait(self, key: str, timeout: float = None,
+             interval: float = 0.05) -> Optional[bytes]:
+        """Waits for another caller to fill a key it has locked.
+
+        Args:
+            key (str): The cache key being rebuilt
+            timeout (float): Maximum number of seconds to wait. Defaults to
+                CACHE_LOCK_WAIT.
+
+        Returns:
+            bytes: The cached body, or None if it did not show up in time
+        """
+        deadline = time.monotonic() + (timeout or lock_wait)
+        lock_key = 'lock:{}'.format(key)
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            body, _ = self._get_body(key)
+            if body is not None:
+                self.record('coalesced')
+                return body
+            if not self._redis.exists(lock_key):
+                # The holder gave up without filling the key
+                break
+        self.record('coalesce_timeouts')
+        return None
+
+    def record(self, stat: str, amount: int = 1) -> None:
+        """Increments one of the cache statistics counters."""
+        self.metrics.incr(stat, amount)
+
+    def stats(self) -> dict:
+        """Returns the cache metrics of all workers."""
+        return self.metrics.snapshot()
+
+    def invalidate(self, *tags: str) -> int:
+        """Removes every cached entry recorded under any of the given tags.
+
+        Args:
+            tags: The entities that changed, e.g. 'products' or 'cart:3'
+
+        Returns:
+            int: Number of cached entries removed
+        """
+        tag_keys = [self._tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return 0
+        try:
+            keys = self._redis.sunion(tag_keys)
+            pipe = self._redis.pipeline()
+            if keys:
+                pipe.delete(*keys)
+            pipe.delete(*tag_keys)
+            pipe.execute()
+            if keys:
+                self._broadcast(list(keys))
+            return len(keys)
+        except Exception as e:
+            print(f"Error invalidating tags {tags}: {e}")
+            return 0
+
+    def flush(self, *namespaces: str) -> dict:
+        """Invalidates all cached data of the given namespaces, or of every
+        namespace if none is given.
+
+        Instead of deleting keys, the namespace generation is bumped so that
+        new keys are used from then on, and the old ones age out through
+        their TTL. Other data in the redis database is left alone.
+
+        Returns:
+            dict: The new generation of each flushed namespace
+
+        Raises:
+            ValueError: When a namespace is not one of NAMESPACES
         """
-        self._redis.flushdb(True)
+        unknown = set(namespaces) - set(NAMESPACES)
+        if unknown:
+            raise ValueError("Unknown cache namespaces: {}".format(
+                ', '.join(sorted(unknown))))
+        namespaces = namespaces or NAMESPACES
+        pipe = self._redis.pipeline()
+        for namespace in namespaces:
+            pipe.hincrby(GENERATIONS_KEY, namespace, 1)
+        generations = dict(zip(namespaces, pipe.execute()))
+        for namespace, gen in generations.items():
+            self._generations[namespace] = (gen, time.monotonic())
+        self._broadcast(None)
+        return generations
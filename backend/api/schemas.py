@@ -1,11 +1,13 @@
+from functools import lru_cache
+
+from webargs.fields import DelimitedList
 from marshmallow import validate, validates, validates_schema, \
     ValidationError, post_dump, pre_load
 from apifairy.fields import FileField
 from api import ma, db
 from api.auth import token_auth
 from api.models import User, Artist, Product, Order, Cart
-
-paginated_schema_cache = {}
+from api.uniqueness import unique_violations
 
 
 class EmptySchema(ma.Schema):
@@ -19,13 +21,18 @@ class DateTimePaginationSchema(ma.Schema):
     limit = ma.Integer()
     offset = ma.Integer()
     after = ma.DateTime(load_only=True)
+    cursor = ma.String(load_only=True)
+    fields = ma.String(load_only=True)
     count = ma.Integer(dump_only=True)
     total = ma.Integer(dump_only=True)
+    has_more = ma.Boolean(dump_only=True)
 
     @validates_schema
     def validate_schema(self, data, **kwargs):
-        if data.get('offset') is not None and data.get('after') is not None:
-            raise ValidationError('Cannot specify both offset and after')
+        if len([arg for arg in ('offset', 'after', 'cursor')
+                if data.get(arg) is not None]) > 1:
+            raise ValidationError(
+                'Only one of offset, after and cursor can be specified')
 
 
 class StringPaginationSchema(ma.Schema):
@@ -35,33 +42,65 @@ class StringPaginationSchema(ma.Schema):
     limit = ma.Integer()
     offset = ma.Integer()
     after = ma.String(load_only=True)
+    cursor = ma.String(load_only=True)
+    fields = ma.String(load_only=True)
     count = ma.Integer(dump_only=True)
     total = ma.Integer(dump_only=True)
+    has_more = ma.Boolean(dump_only=True)
 
     @validates_schema
     def validate_schema(self, data, **kwargs):
-        if data.get('offset') is not None and data.get('after') is not None:
-            raise ValidationError('Cannot specify both offset and after')
+        if len([arg for arg in ('offset', 'after', 'cursor')
+                if data.get(arg) is not None]) > 1:
+            raise ValidationError(
+                'Only one of offset, after and cursor can be specified')
+
+
+class ProductPaginationSchema(DateTimePaginationSchema):
+    active = ma.Boolean(load_only=True)
 
 
 def PaginatedCollection(schema, pagination_schema=StringPaginationSchema):
-    if schema in paginated_schema_cache:
-        return paginated_schema_cache[schema]
+    only = tuple(sorted(schema.only)) if schema.only else None
+    return paginated_collection(schema.__class__, only, pagination_schema)
 
+
+@lru_cache(maxsize=256)
+def paginated_collection(schema_class, only, pagination_schema):
+    """Return the paginated schema of a schema class narrowed to the given
+    sorted tuple of fields, if any.
+
+    Schemas are cached per class rather than per instance, so that the
+    instances of narrowed_schema() share them.
+    """
     class PaginatedSchema(ma.Schema):
         class Meta:
             ordered = True
 
         pagination = ma.Nested(pagination_schema)
-        data = ma.Nested(schema, many=True)
+        data = ma.Nested(schema_class(only=only), many=True)
         extra_data = ma.Dict()
         source = ma.String()
+        next_cursor = ma.String()
+        prev_cursor = ma.String()
 
-    PaginatedSchema.__name__ = 'Paginated{}'.format(schema.__class__.__name__)
-    paginated_schema_cache[schema] = PaginatedSchema
+    PaginatedSchema.__name__ = 'Paginated{}'.format(schema_class.__name__)
     return PaginatedSchema
 
 
+@lru_cache(maxsize=256)
+def narrowed_schema(schema, fields):
+    """Return an instance of the schema that only dumps the given fields.
+
+    Instances are cached per schema and sorted tuple of fields, so that a
+    ?fields= request does not build a new schema every time.
+    """
+    unknown = set(fields) - set(schema.dump_fields)
+    if unknown:
+        raise ValidationError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return schema.__class__(many=schema.many, only=fields)
+
+
 class CartSchema(ma.SQLAlchemySchema):
     class Meta:
         model = Cart
@@ -97,6 +136,9 @@ class UserSchema(ma.SQLAlchemySchema):
         model = User
         ordered = True
 
+    # Columns read by the properties below, see api.decorators.load_only
+    field_columns = {'url': ('id',), 'avatar': ('email',)}
+
     id = ma.auto_field(dump_only=True)  # Id is read-only
     url = ma.String(dump_only=True)
     cart_size = ma.Integer(dump_only=True)
@@ -107,6 +149,7 @@ class UserSchema(ma.SQLAlchemySchema):
     email = ma.auto_field(required=True)
     password = ma.String(required=True, load_only=True)
     role = ma.String()
+    last_seen = ma.auto_field(dump_only=True)
 
     @validates('first_name')
     def validate_first_name(self, value):
@@ -136,10 +179,6 @@ class UserSchema(ma.SQLAlchemySchema):
             raise ValidationError("Username must start with a letter.")
         if len(value) > 64:
             raise ValidationError("Username must not exceed 64 characters.")
-        user = token_auth.current_user()
-        old_username = user.username if user else None
-        if value != old_username and db.session.query(User).filter_by(username=value).first():
-            raise ValidationError("This username has been taken, try another!")
         return value
 
     @validates('email')
@@ -148,12 +187,18 @@ class UserSchema(ma.SQLAlchemySchema):
             raise ValidationError("Email must not exceed 120 characters.")
         if not validate.Email()(value):
             raise ValidationError("Invalid email format.")
-        user = token_auth.current_user()
-        old_email = user.email if user else None
-        if value != old_email and db.session.query(User).filter_by(email=value).first():
-            raise ValidationError("This email has been taken, try another!")
         return value
 
+    @validates_schema
+    def validate_unique(self, data, **kwargs):
+        # One query for both fields, the user's own values are not taken
+        user = token_auth.current_user()
+        errors = unique_violations(
+            User, {field: data.get(field) for field in ('username', 'email')},
+            exclude_id=user.id if user else None)
+        if errors:
+            raise ValidationError(errors)
+
     @validates('password')
     def validate_password(self, value):
         if len(value) < 8:
@@ -174,9 +219,9 @@ class UserSchema(ma.SQLAlchemySchema):
 
     @post_dump
     def fix_datetimes(self, data, **kwargs):
-        if 'first_seen' in data:
+        if data.get('first_seen'):
             data['first_seen'] += 'Z'
-        if 'last_seen' in data:
+        if data.get('last_seen'):
             data['last_seen'] += 'Z'
         return data
 
@@ -205,12 +250,16 @@ class ArtistSchema(ma.SQLAlchemySchema):
     def validate_name(self, value):
         if not value.strip():
             raise ValidationError("Name cannot be empty.")
-        if db.session.query(Artist).filter(Artist.name == value).first():
-            raise ValidationError("This artist has already been registered!")
         if len(value) > 120:
             raise ValidationError("Name must not exceed 120 characters.")
         return value
 
+    @validates_schema
+    def validate_unique(self, data, **kwargs):
+        errors = unique_violations(Artist, {'name': data.get('name')})
+        if errors:
+            raise ValidationError(errors)
+
     @validates('image')
     def validate_image(self, value):
         if not value or not hasattr(value, 'filename'):
@@ -248,11 +297,19 @@ class ProductSchema(ma.SQLAlchemySchema):
         include_fk = True
         ordered = True
 
+    # Columns read by the properties below, see api.decorators.load_only
+    field_columns = {
+        'days_left': ('expires_at', 'timestamp', 'deadline'),
+        'artist_details': ('artist',),
+        'artist_website': ('artist',),
+    }
+
     id = ma.Integer(dump_only=True)
     title = ma.auto_field(required=True)
     deadline = ma.auto_field(required=True)
     days_left = ma.Integer(dump_only=True)
     expire = ma.auto_field(dump_only=True)
+    expires_at = ma.auto_field(dump_only=True)
     goal = ma.auto_field(required=True)
     price = ma.auto_field(required=True)
     artist_name = ma.String(required=True)
@@ -427,4 +484,28 @@ class PasswordResetSchema(ma.Schema):
 
 class OAuth2Schema(ma.Schema):
     code = ma.String(required=True)
-    state = ma.String(required=True)
\ No newline at end of file
+    state = ma.String(required=True)
+
+
+class ProductIdsSchema(ma.Schema):
+    ids = ma.List(ma.Integer(), required=True,
+                  validate=validate.Length(min=1, max=100))
+
+
+class ProductIdsQuerySchema(ma.Schema):
+    ids = DelimitedList(ma.Integer(), required=True,
+                        validate=validate.Length(min=1, max=100))
+
+
+class ProductFilterSchema(ma.Schema):
+    artist = ma.String()
+    color = ma.String()
+    created_before = ma.DateTime()
+
+
+class ProductBatchSchema(ma.Schema):
+    class Meta:
+        ordered = True
+
+    data = ma.Nested(ProductSchema, many=True)
+    missing = ma.List(ma.Integer())
@@ -0,0 +1,100 @@
+"""
+Periodic background tasks.
+
+Tasks run in a daemon thread of each worker, started with the worker's
+first request so that CLI commands don't run them. When caching is
+enabled, a redis lock held for the task's interval lets a single worker
+run each round of an exclusive task. Other tasks run in every worker, for
+work on the worker's own state, and can also run once more when the worker
+exits.
+"""
+import atexit
+import os
+import threading
+import time
+from typing import Callable
+
+
+class Scheduler:
+    """Runs registered functions every few seconds in the app context."""
+
+    def __init__(self) -> None:
+        self.tasks = {}
+        self.app = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        self.app = app
+        app.before_request(self._start)
+
+    def task(self, name: str, interval_option: str,
+             exclusive: bool = True, at_exit: bool = False) -> Callable:
+        """Registers a task run every `interval_option` seconds, as read
+        from the app config. A missing or 0 interval disables the task.
+        Tasks that are not exclusive run in every worker, and `at_exit`
+        ones also run when a worker that started them exits normally.
+        """
+        def decorator(f: Callable) -> Callable:
+            self.tasks[name] = (f, interval_option, exclusive, at_exit)
+            return f
+        return decorator
+
+    def run(self, name: str) -> None:
+        """Runs a task once, in the current app context."""
+        from api.app import db
+
+        f = self.tasks[name][0]
+        try:
+            f()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error running task {name}: {e}")
+        finally:
+            db.session.remove()
+
+    def _start(self) -> None:
+        """Starts the task threads of this worker, once per process."""
+        if self._pid == os.getpid() or self.app.testing:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for name, (_, interval_option, exclusive, at_exit) in \
+                    self.tasks.items():
+                interval = self.app.config.get(interval_option)
+                if interval:
+                    threading.Thread(target=self._loop,
+                                     args=(self.app, name, interval, exclusive),
+                                     daemon=True).start()
+                    if at_exit:
+                        atexit.register(self._run_at_exit, self.app, name)
+
+    def _loop(self, app, name: str, interval: float,
+              exclusive: bool = True) -> None:
+        while True:
+            time.sleep(interval)
+            if not exclusive or self._acquire(name, interval):
+                with app.app_context():
+                    self.run(name)
+
+    def _run_at_exit(self, app, name: str) -> None:
+        """Runs a task a last time, unless this process is not the worker
+        that registered it."""
+        if self._pid == os.getpid():
+            with app.app_context():
+                self.run(name)
+
+    def _acquire(self, name: str, interval: float) -> bool:
+        """Returns whether this worker runs the current round of a task."""
+        from api.app import cache
+
+        try:
+            # The lock expires on its own, so that no other worker runs
+            # the task before the next round
+            return cache is None or \
+                cache.lock(f'task:{name}', timeout=interval) is not None
+        except Exception as e:
+            print(f"Error locking task {name}: {e}")
+            return True
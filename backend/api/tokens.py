@@ -6,7 +6,7 @@ from werkzeug.http import dump_cookie
 from apifairy import authenticate, body, response, other_responses
 import requests
 
-from api.app import db
+from api.app import db, scheduler
 from api.auth import basic_auth, token_auth
 from api.email import send_email
 from api.models import User, Token
@@ -50,7 +50,6 @@ def new():
     user = basic_auth.current_user()
     token = user.generate_auth_token()
     db.session.add(token)
-    Token.clean()  # keep token table clean of old tokens
     db.session.commit()
     return token_response(token)
 
@@ -192,6 +191,11 @@ def oauth2_new(args, provider):
         db.session.add(user)
     token = user.generate_auth_token()
     db.session.add(token)
-    Token.clean()  # keep token table clean of old tokens
     db.session.commit()
     return token_response(token)
+
+
+@scheduler.task('clean_tokens', 'TOKEN_CLEAN_INTERVAL')
+def clean_tokens():
+    """Remove the tokens expired for more than a day"""
+    Token.clean(current_app.config['BULK_CHUNK_SIZE'])
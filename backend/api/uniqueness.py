@@ -0,0 +1,170 @@
+"""
+Uniqueness checks of the values sent to the API.
+
+unique_violations() probes all the unique fields of a payload in a single
+query. With UNIQUE_PRECHECK off, only the fields that no unique constraint
+guards, such as emails, are probed. When UNIQUE_BLOOM_FILTER is set, usernames that a per-worker Bloom
+filter has never seen are known to be available without a query. A username
+taken by another worker in the meantime is then rejected by the unique
+constraint, and the IntegrityError of the INSERT is reported as a field
+error like the probe's, see api.errors.
+"""
+from hashlib import blake2b
+import math
+import os
+import re
+import threading
+import time
+
+import sqlalchemy as sa
+from flask import current_app
+
+from api.app import db
+from api.models import User
+
+# The error of each unique column, by table and column name
+MESSAGES = {
+    ('users', 'username'): "This username has been taken, try another!",
+    ('users', 'email'): "This email has been taken, try another!",
+    ('artists', 'name'): "This artist has already been registered!",
+    ('products', 'title'): "This product title already exists, try another!",
+}
+
+# Unique columns whose existing values are kept in Bloom filters
+BLOOM_COLUMNS = {('users', 'username')}
+
+SQLITE_UNIQUE = re.compile(r'UNIQUE constraint failed: ([\w.]+(?:, [\w.]+)*)')
+MYSQL_UNIQUE = re.compile(r"Duplicate entry '.*' for key '(?:\w+\.)?(\w+)'")
+
+
+class BloomFilter:
+    """A set of strings that may answer 'maybe' for values it doesn't hold,
+    but never misses one it does."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str):
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big')
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position // 8] |= 1 << position % 8
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position // 8] & 1 << position % 8
+                   for position in self._positions(value))
+
+
+class ValueFilters:
+    """The Bloom filters of the BLOOM_COLUMNS in this worker.
+
+    A filter is loaded from the database on first use and again every
+    UNIQUE_BLOOM_TTL seconds. Values are folded to lower case, so that case
+    insensitive collations only cause extra probes.
+    """
+
+    def __init__(self) -> None:
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def might_exist(self, model, field: str, value: str) -> bool:
+        key = (model.__tablename__, field)
+        column = getattr(model, field)
+        ttl = current_app.config['UNIQUE_BLOOM_TTL']
+        entry = self._filters.get(key)
+        if entry is None or entry[1] != os.getpid() or \
+                time.monotonic() - entry[2] > ttl:
+            values = db.session.scalars(
+                sa.select(column).where(column.is_not(None))).all()
+            bloom = BloomFilter(max(2 * len(values), 1024))
+            for existing in values:
+                bloom.add(existing.lower())
+            entry = (bloom, os.getpid(), time.monotonic())
+            with self._lock:
+                self._filters[key] = entry
+        return value.lower() in entry[0]
+
+    def add(self, model, field: str, value: str) -> None:
+        entry = self._filters.get((model.__tablename__, field))
+        if entry is not None and value is not None:
+            entry[0].add(value.lower())
+
+
+filters = ValueFilters()
+
+
+def unique_violations(model, values: dict, exclude_id: int = None) -> dict:
+    """Return the fields whose value is already used by another row.
+
+    Args:
+        model: The model holding the unique columns
+        values (dict): The values to check, by field name
+        exclude_id (int): The id of the row being updated, if any
+
+    Returns:
+        dict: The errors of the taken fields, by field name
+    """
+    values = {field: value for field, value in values.items()
+              if value is not None}
+    if not current_app.config.get('UNIQUE_PRECHECK'):
+        # The constraints report the other fields, see integrity_violations()
+        values = {field: value for field, value in values.items()
+                  if not model.__table__.c[field].unique}
+    if current_app.config.get('UNIQUE_BLOOM_FILTER'):
+        values = {field: value for field, value in values.items()
+                  if (model.__tablename__, field) not in BLOOM_COLUMNS or
+                  filters.might_exist(model, field, value)}
+    if not values:
+        return {}
+    columns = [getattr(model, field) for field in values]
+    query = sa.select(*columns).where(sa.or_(
+        *[column == value for column, value in zip(columns, values.values())]))
+    if exclude_id is not None:
+        query = query.where(model.id != exclude_id)
+    # No LIMIT, rows sharing a value of a non unique column, like emails,
+    # could take the place of the row colliding on another field
+    taken = {}
+    for row in db.session.execute(query):
+        for (field, value), existing in zip(values.items(), row):
+            if isinstance(existing, str) and \
+                    existing.casefold() == value.casefold():
+                taken[field] = [MESSAGES[(model.__tablename__, field)]]
+    return taken
+
+
+def integrity_violations(error) -> dict:
+    """Return the field errors of a unique constraint violation, or an
+    empty dict for other integrity errors."""
+    message = str(error.orig)
+    columns = []
+    match = SQLITE_UNIQUE.search(message)
+    if match:
+        columns = [tuple(name.split('.'))
+                   for name in match.group(1).split(', ')]
+    match = MYSQL_UNIQUE.search(message)
+    if match:
+        # MySQL names the index, which is either the column or ix_<table>_<column>
+        for table in db.metadata.tables.values():
+            for index in list(table.indexes) + list(table.constraints):
+                if index.name == match.group(1) and \
+                        isinstance(index, (sa.Index, sa.UniqueConstraint)):
+                    columns = [(table.name, column.name)
+                               for column in index.columns]
+            if match.group(1) in table.c and table.c[match.group(1)].unique:
+                columns = [(table.name, match.group(1))]
+    return {column: [MESSAGES[(table, column)]]
+            for table, column in columns if (table, column) in MESSAGES}
+
+
+@sa.event.listens_for(User, 'after_insert')
+@sa.event.listens_for(User, 'after_update')
+def remember_username(mapper, connection, user):
+    """Add new usernames to this worker's Bloom filter."""
+    filters.add(User, 'username', user.username)
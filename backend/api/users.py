@@ -3,11 +3,12 @@ from flask import Blueprint, abort
 from apifairy import authenticate, body, response
 
 from api import db
-from api.app import cache
+from api.app import cache, scheduler, activity
 from api.models import User
 from api.schemas import UserSchema, UpdateUserSchema, DateTimePaginationSchema
 from api.auth import token_auth, role_required
-from api.decorators import paginated_response
+from api.decorators import paginated_response, entity_response
+from api import loaders
 
 users_bp = Blueprint('users', __name__)
 user_schema = UserSchema()
@@ -24,7 +25,7 @@ def new(args):
     db.session.add(user)
     db.session.commit()
     if cache is not None:
-        cache.flush() # Clear the cache. # Clear the cache.
+        cache.invalidate('users')
     return user
 
 
@@ -32,7 +33,9 @@ def new(args):
 @authenticate(token_auth)
 @paginated_response(users_schema, order_by=User.timestamp,
                     order_direction='desc',
-                    pagination_schema=DateTimePaginationSchema)
+                    pagination_schema=DateTimePaginationSchema,
+                    cache_tags=('users', 'carts'), total_mode='cached',
+                    loader=loaders.USERS)
 def all():
     """Retrieve all users"""
     return db.session.query(User).filter(User.role != 'admin')
@@ -40,7 +43,8 @@ def all():
 
 @users_bp.route('/users/<int:id>', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@response(user_schema)
+@entity_response(user_schema, User,
+                 depends_on=lambda user: [f'cart:{user.id}'])
 @other_responses({404: 'User not found'})
 def get(id):
     """Retrieve a user by id"""
@@ -49,11 +53,12 @@ def get(id):
 
 @users_bp.route('/users/<username>', methods=['GET'], strict_slashes=False)
 @authenticate(token_auth)
-@response(user_schema)
+@entity_response(user_schema, User, column='username',
+                 depends_on=lambda user: [f'cart:{user.id}'])
 @other_responses({404: 'User not found'})
 def get_by_username(username):
     """Retrieve a user by username"""
-    return db.session.query(User).filter_by(username=username).one() or \
+    return db.session.query(User).filter_by(username=username).first() or \
         abort(404)
 
 
@@ -79,7 +84,7 @@ def put(data):
     user.update(data)
     db.session.commit()
     if cache is not None:
-        cache.flush() # Clear the cache. # Clear the cache.
+        cache.invalidate('users')
     return user
 
 
@@ -89,8 +94,22 @@ def put(data):
 def delete_user(id):
     """Delete user"""
     user = db.session.get(User, id)
+    user.revoke_all()
     db.session.delete(user)
     db.session.commit()
     if cache is not None:
-        cache.flush() # Clear the cache. # Clear the cache.
-    return {}
\ No newline at end of file
+        # Carts and orders cascade with their customer
+        cache.invalidate('users', 'carts', 'orders', f'cart:{id}')
+    return {}
+
+
+@scheduler.task('save_activity', 'ACTIVITY_FLUSH_INTERVAL', exclusive=False,
+                at_exit=True)
+def save_activity():
+    """Write the last seen times buffered by this worker to the database"""
+    seen = activity.drain()
+    try:
+        User.save_activity(seen)
+    except Exception:
+        activity.restore(seen)
+        raise
@@ -5,7 +5,7 @@ from flask import current_app, abort
 import random
 from faker import Faker
 from datetime import timezone
-from api.app import create_app, db
+from api.app import create_app, db, cache
 from api.models import User, Product, Cart, Order, Artist
 
 fake = Faker()
@@ -153,13 +153,9 @@ def carts(num):
             user = User.query.order_by(db.func.random()).first()  # Randomly pick a user
             product = Product.query.order_by(db.func.random()).first()  # Randomly pick a Product
 
-            fake_cart = Cart(
-                quantity=fake.random_int(min=1, max=5),  # Random quantity between 1 and 5
-                customer_id=user.id,  # Assign the random user
-                product_id=product.id,  # Assign the random Product
-                size=random.choice(["S", "M", "L", "XL"]),
-            )
-            db.session.add(fake_cart)
+            # Picking the same product and size again adds to its quantity
+            Cart.add(user.id, product.id, random.choice(["S", "M", "L", "XL"]),
+                     quantity=fake.random_int(min=1, max=5))
         db.session.commit()
         # print("{} carts instances has been created!".format(num))
     except Exception as e:
@@ -184,6 +180,8 @@ def handle_successful_payment(session):
         for item in user.cart_items:
             db.session.delete(item)
         db.session.commit()
+        if cache is not None:
+            cache.invalidate('carts', f'cart:{user.id}')
 
         try:
             ordered_items = session['line_items']['data']
@@ -200,6 +198,8 @@ def handle_successful_payment(session):
                 )
             db.session.add(new_order)
             db.session.commit()
+            if cache is not None:
+                cache.invalidate('orders')
         except Exception as e:
             abort(500, f"Error create orders: {e}")
     
@@ -37,11 +37,46 @@ class Config(object):
     REFRESH_TOKEN_DAYS = int(os.environ.get('REFRESH_TOKEN_DAYS') or '7')
     REFRESH_TOKEN_IN_COOKIE = as_bool(os.environ.get(
         'REFRESH_TOKEN_IN_COOKIE') or 'yes')
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'scrypt:32768:8:1'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or '2')
+    STATELESS_ACCESS_TOKENS = as_bool(
+        os.environ.get('STATELESS_ACCESS_TOKENS'))
     REFRESH_TOKEN_IN_BODY = as_bool(os.environ.get('REFRESH_TOKEN_IN_BODY'))
     RESET_TOKEN_MINUTES = int(os.environ.get('RESET_TOKEN_MINUTES') or '15')
     PASSWORD_RESET_URL = os.environ.get('PASSWORD_RESET_URL') or \
         'http://localhost:4000/reset'
     USE_CORS = as_bool(os.environ.get('USE_CORS') or 'yes')
+    RAISE_ON_LAZY_LOAD = as_bool(os.environ.get('RAISE_ON_LAZY_LOAD'))
+    PRODUCT_EXPIRY_INTERVAL = int(
+        os.environ.get('PRODUCT_EXPIRY_INTERVAL') or '300')
+    TOKEN_CLEAN_INTERVAL = int(
+        os.environ.get('TOKEN_CLEAN_INTERVAL') or '3600')
+    ACTIVITY_FLUSH_INTERVAL = int(
+        os.environ.get('ACTIVITY_FLUSH_INTERVAL') or '60')
+    RATELIMIT_STORAGE_URI = os.environ.get('REDIS_URI') or 'memory://'
+    RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY') or \
+        'local-token-bucket'
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True
+    RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT') or \
+        '1000 per hour'
+    RATELIMIT_BUDGETS = {
+        # Catalog pages are cached, clients may browse them quickly
+        'catalog': {
+            'anonymous': os.environ.get('RATELIMIT_CATALOG') or '120 per minute',
+            'default': os.environ.get('RATELIMIT_CATALOG_USER') or '300 per minute',
+            'admin': '1000 per minute',
+        },
+        'writes': {
+            'anonymous': os.environ.get('RATELIMIT_WRITES') or '10 per minute',
+            'default': os.environ.get('RATELIMIT_WRITES_USER') or '60 per minute',
+            'admin': '600 per minute',
+        },
+    }
+    UNIQUE_PRECHECK = as_bool(os.environ.get('UNIQUE_PRECHECK') or 'yes')
+    UNIQUE_BLOOM_FILTER = as_bool(os.environ.get('UNIQUE_BLOOM_FILTER'))
+    UNIQUE_BLOOM_TTL = int(os.environ.get('UNIQUE_BLOOM_TTL') or '300')
+    BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE') or '1000')
     CORS_SUPPORTS_CREDENTIALS = True
     OAUTH2_PROVIDERS = {
         # https://developers.google.com/identity/protocols/oauth2/web-server
@@ -27,4 +27,7 @@ else
         echo "Upgrade command failed, retrying in 5 seconds..."
         sleep 5
     done
-fi
\ No newline at end of file
+fi
+# Drop the cached data of the previous release, once per deploy rather than
+# on every boot of a worker container
+flask cache flush || echo "Cache flush failed, cached data will expire on its own."
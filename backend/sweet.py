@@ -3,8 +3,11 @@ import click
 import logging
 from logging.handlers import RotatingFileHandler, SMTPHandler
 
-from api.app import create_app
+from api.app import create_app, cache, scheduler
+from api.redis import NAMESPACES
 from api.utilities import users, artists, products, orders, carts
+from api.benchmarks import cache_codecs, login_throughput
+from api.products import bulk_expire_products, bulk_delete_products
 app = create_app()
 
 
@@ -38,6 +41,90 @@ def create(num):
     except Exception as e:
         print("Error: {}".format(e))
 
+@app.cli.group('cache')
+def cache_cli():
+    """Managing the redis cache"""
+    pass
+
+@cache_cli.command()
+@click.argument('namespaces', nargs=-1, type=click.Choice(NAMESPACES))
+def flush(namespaces):
+    """Invalidate the cached data of the given namespaces.
+
+    All namespaces are flushed when none is given. Old keys are not deleted,
+    they expire on their own.
+    """
+    if cache is None:
+        print("Redis caching is disabled for this application!")
+        return
+    for namespace, generation in cache.flush(*namespaces).items():
+        print("Namespace {} is now at generation {}.".format(namespace, generation))
+
+@cache_cli.command()
+@click.option('--pages', default=20, help='Number of catalog pages to encode.')
+@click.option('--limit', default=25, help='Number of products per page.')
+@click.option('--rounds', default=50, help='Number of times each page is encoded.')
+def bench(pages, limit, rounds):
+    """Compare the cache codecs on the seeded catalog."""
+    cache_codecs(pages, limit, rounds)
+
+@app.cli.group('auth')
+def auth_cli():
+    """Measuring the authentication path"""
+    pass
+
+@auth_cli.command('bench')
+@click.option('--username', default='testuser', help='User to log in as.')
+@click.option('--password', default='123456', help='Password of the user.')
+@click.option('--logins', default=40, help='Number of logins per run.')
+@click.option('--clients', default='1,2,4,8', help='Comma separated numbers of concurrent clients.')
+def auth_bench(username, password, logins, clients):
+    """Measure the login throughput."""
+    login_throughput(username, password, logins,
+                     [int(n) for n in clients.split(',')])
+
+@app.cli.group()
+def tasks():
+    """Running background tasks"""
+    pass
+
+@tasks.command()
+@click.argument('name', type=click.Choice(sorted(scheduler.tasks)))
+def run(name):
+    """Run a background task once, e.g. from cron."""
+    scheduler.run(name)
+
+@app.cli.group('products')
+def products_cli():
+    """Bulk actions on the products"""
+    pass
+
+def product_filters(command):
+    """Add the options selecting the products of a bulk action."""
+    command = click.option('--artist', help='Only the products of this artist.')(command)
+    command = click.option('--color', help='Only the products of this color.')(command)
+    return click.option('--created-before', type=click.DateTime(),
+                        help='Only the products created before this date.')(command)
+
+def progress(action):
+    return lambda done: print("{} {} products...".format(action, done))
+
+@products_cli.command()
+@product_filters
+def expire(artist, color, created_before):
+    """Expire the products, all of them unless filtered."""
+    count = bulk_expire_products(progress('Expired'), artist=artist, color=color,
+                                 created_before=created_before)
+    print("{} products expired.".format(count))
+
+@products_cli.command()
+@product_filters
+def delete(artist, color, created_before):
+    """Delete the products, all of them unless filtered."""
+    count = bulk_delete_products(progress('Deleted'), artist=artist, color=color,
+                                 created_before=created_before)
+    print("{} products deleted.".format(count))
+
 if not app.debug:
     # Ensure the logs directory exists
     if not os.path.exists('logs'):
@@ -0,0 +1,78 @@
+from importlib import import_module
+import os
+import unittest
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover
+    fakeredis = None
+
+os.environ.setdefault('ENV', 'local')
+os.environ['USE_CACHE'] = 'no'
+
+from api.app import create_app, db  # noqa: E402
+from api.redis import Cache  # noqa: E402
+from config import Config  # noqa: E402
+
+# The modules holding a reference to the app's cache
+CACHE_MODULES = ('api.app', 'api.models', 'api.decorators', 'api.products',
+                 'api.artists', 'api.carts', 'api.users', 'api.orders',
+                 'api.admin', 'api.utilities')
+
+
+class TestConfig(Config):
+    SERVER_NAME = 'localhost:5000'
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'top-secret-test-key-of-at-least-32-bytes'
+    RATELIMIT_ENABLED = False
+    REFRESH_TOKEN_IN_BODY = True
+    RAISE_ON_LAZY_LOAD = True
+
+
+class BaseTestCase(unittest.TestCase):
+    config = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.close()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username, password='123456'):
+        rv = self.client.post('/api/tokens', auth=(username, password))
+        return {'Authorization': 'Bearer ' + rv.json['access_token']}
+
+
+@unittest.skipUnless(fakeredis, 'the cache tests require fakeredis')
+class CacheTestCase(BaseTestCase):
+    """Runs the app with a cache backed by an in-memory redis."""
+    cache_options = {}
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.cache = Cache(**self.cache_options)
+        self.redis = fakeredis.FakeRedis(server=server, decode_responses=True)
+        self.cache._redis = self.cache.metrics._redis = self.redis
+        self.cache._binary = fakeredis.FakeRedis(server=server)
+        for module in CACHE_MODULES:
+            # Import first, or a module importing the patched cache of
+            # api.app would keep it as the original to restore
+            import_module(module)
+        for module in CACHE_MODULES:
+            patcher = mock.patch(f'{module}.cache', self.cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        if self.cache._listener is not None:
+            self.cache._listener.stop()
@@ -0,0 +1,222 @@
+import gzip
+import hashlib
+import threading
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+from flask import Flask
+
+from api import utilities
+from api.app import db
+from api.models import User
+from api.redis import CacheMetrics
+from tests.base_test_case import CacheTestCase
+
+
+class PageCacheTests(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.users(3)
+        self.headers = self.login('testadmin')
+
+    def source(self, url, headers=None):
+        rv = self.client.get(url, headers=headers or self.headers)
+        self.assertEqual(rv.status_code, 200, rv.json)
+        return rv.json['source']
+
+    def test_write_invalidates_tagged_pages(self):
+        self.assertEqual(self.source('/api/users'), 'db')
+        self.assertEqual(self.source('/api/users'), 'cache')
+        rv = self.client.put('/api/me', json={'first_name': 'renamed'},
+                             headers=self.login('testuser'))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.source('/api/users'), 'db')
+        names = [user['first_name'] for user in
+                 self.client.get('/api/users', headers=self.headers)
+                 .json['data']]
+        self.assertIn('renamed', names)
+
+    def test_other_tags_keep_pages(self):
+        self.source('/api/users')
+        self.cache.invalidate('orders', 'products')
+        self.assertEqual(self.source('/api/users'), 'cache')
+
+    def test_role_scoped_pages_are_not_shared(self):
+        self.assertEqual(self.source('/api/carts'), 'db')
+        self.assertEqual(self.source('/api/carts'), 'cache')
+        rv = self.client.get('/api/carts', headers=self.login('testuser'))
+        self.assertEqual(rv.status_code, 403)
+
+    def test_user_scoped_pages_are_not_shared(self):
+        utilities.artists(1)
+        utilities.products(1)
+        user = self.login('testuser')
+        rv = self.client.post('/api/products/carts/1', json={'size': 'M'},
+                              headers=user)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.source('/api/me/carts', user), 'db')
+        self.assertEqual(self.source('/api/me/carts', user), 'cache')
+        rv = self.client.get('/api/me/carts', headers=self.headers)
+        self.assertEqual(rv.json['source'], 'db')
+        self.assertEqual(rv.json['data'], [])
+
+    def test_concurrent_misses_wait_for_the_first(self):
+        key = self.cache.versioned('pages', '/api/products:{}')
+        lock = self.cache.lock(key)
+        filler = threading.Timer(0.2, self.cache.set,
+                                 (key, b'{"source": "filled"}'))
+        filler.start()
+        rv = self.client.get('/api/products')
+        filler.join()
+        self.cache.unlock(lock)
+        self.assertEqual(rv.json, {'source': 'filled'})
+        self.assertEqual(self.cache.stats()['counters']['coalesced'], 1)
+
+    def test_stale_pages_are_served_while_rebuilt(self):
+        key = self.cache.versioned('pages', '/api/products:{}')
+        self.assertEqual(self.source('/api/products'), 'db')
+        # Past the page's cache_ttl, within its stale_ttl of 10 seconds
+        self.redis.set(key, b'{"source": "stale"}', ex=5)
+        rv = self.client.get('/api/products')
+        self.assertEqual(rv.json, {'source': 'stale'})
+        for _ in range(50):
+            if self.redis.ttl(key) > 10:
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.source('/api/products'), 'cache')
+
+    def test_hits_return_the_cached_body(self):
+        key = self.cache.versioned('pages', '/api/products:{}')
+        self.assertEqual(self.source('/api/products'), 'db')
+        body = self.client.get('/api/products').get_data()
+        self.assertEqual(body, self.cache._binary.get(key))
+
+    def test_gzipped_bodies(self):
+        key = self.cache.versioned('pages', '/api/products:{}')
+        self.cache.set(key, gzip.compress(b'{"source": "gzip"}'))
+        rv = self.client.get('/api/products',
+                             headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(rv.get_data()),
+                         b'{"source": "gzip"}')
+        rv = self.client.get('/api/products')
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEqual(rv.json, {'source': 'gzip'})
+
+    def test_entity_bodies_follow_their_rows(self):
+        url = '/api/users/testuser'
+        self.assertEqual(self.client.get(url, headers=self.headers)
+                         .json['first_name'], 'non-admin')
+        user = db.session.scalar(
+            sa.select(User).filter_by(username='testuser'))
+        user.first_name = 'renamed'
+        db.session.commit()
+        self.assertEqual(self.client.get(url, headers=self.headers)
+                         .json['first_name'], 'renamed')
+
+    def test_entity_bodies_follow_their_dependencies(self):
+        utilities.artists(1)
+        utilities.products(1)
+        url = '/api/users/testuser'
+        self.assertEqual(self.client.get(url, headers=self.headers)
+                         .json['cart_size'], 0)
+        rv = self.client.post('/api/products/carts/1', json={'size': 'M'},
+                              headers=self.login('testuser'))
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.client.get(url, headers=self.headers)
+                         .json['cart_size'], 1)
+
+    def test_cached_counts_expire(self):
+        rv = self.client.get('/api/users', headers=self.headers)
+        self.assertEqual(rv.json['pagination']['total'], 4)
+        keys = self.redis.keys('counts:*')
+        self.assertEqual(len(keys), 1)
+        self.assertGreater(self.redis.ttl(keys[0]), 0)
+
+
+class LocalCacheTests(CacheTestCase):
+    cache_options = {'local_size': 10}
+
+    def retry_now(self):
+        pid, _, delay = self.cache._listen_retry
+        self.cache._listen_retry = (pid, 0, delay)
+
+    def test_subscription_failures_back_off(self):
+        self.cache.set('key', {'value': 1})
+        subscribe = self.redis.pubsub
+        with mock.patch.object(self.redis, 'pubsub',
+                               side_effect=ConnectionError) as pubsub:
+            self.assertEqual(self.cache.get('key'), {'value': 1})
+            self.assertEqual(self.cache.get('key'), {'value': 1})
+            self.assertEqual(pubsub.call_count, 1)
+            self.assertIsNotNone(self.cache._local.get('key'))
+
+            self.retry_now()
+            self.cache.get('key')
+            self.assertEqual(pubsub.call_count, 2)
+            self.assertEqual(self.cache._listen_retry[2], 2)
+            # The local copy is only dropped on the first failure
+            self.assertIsNotNone(self.cache._local.get('key'))
+
+        self.retry_now()
+        with mock.patch.object(self.redis, 'pubsub',
+                               side_effect=subscribe) as pubsub:
+            self.cache.get('key')
+            self.cache.get('key')
+        self.assertEqual(pubsub.call_count, 1)
+        self.assertIsNone(self.cache._listen_retry)
+        self.assertIsNotNone(self.cache._listener)
+
+
+class FlushTests(CacheTestCase):
+    def test_flush_moves_namespaces_to_a_new_generation(self):
+        key = self.cache.versioned('pages', '/api/products:{}')
+        self.assertEqual(self.cache.flush('pages'), {'pages': 1})
+        self.assertNotEqual(
+            self.cache.versioned('pages', '/api/products:{}'), key)
+        self.assertEqual(self.cache.generation('counts'), 0)
+
+    def test_unknown_namespaces_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.cache.flush('page')
+        self.assertIsNone(self.redis.hget('cache:generations', 'page'))
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = CacheMetrics(None)
+
+    def test_prefixes_group_keys(self):
+        prefix = self.metrics.prefix
+        self.assertEqual(prefix('pages:3:user:5:/api/me/carts:{}'),
+                         'pages:user:/api/me/carts')
+        self.assertEqual(prefix('pages:3:role:admin:/api/carts:{"limit": 5}'),
+                         'pages:role:admin:/api/carts')
+        self.assertEqual(prefix('pages:0:/api/sales/12:{}'),
+                         'pages:/api/sales/<id>')
+        self.assertEqual(prefix('entities:1:users:username:jane'),
+                         'entities:users:username')
+        self.assertEqual(prefix('entities:1:products:id:7:id,title'),
+                         'entities:products:id')
+        self.assertEqual(prefix('counts:2:' + hashlib.sha1(b'').hexdigest()),
+                         'counts')
+
+    def test_prefixes_are_bounded(self):
+        for i in range(CacheMetrics.MAX_PREFIXES + 10):
+            self.metrics.prefix(f'entities:1:users:username:user{i}')
+            self.metrics.prefix(f'counts:1:{i:040x}')
+        self.assertEqual(self.metrics._prefixes,
+                         {'entities:users:username', 'counts'})
+        for i in range(CacheMetrics.MAX_PREFIXES):
+            self.metrics.prefix(f'pages:1:/api/route{i}x')
+        self.assertEqual(self.metrics.prefix('pages:1:/api/new'), 'other')
+
+    def test_prefixes_use_the_url_rule(self):
+        app = Flask(__name__)
+        app.add_url_rule('/api/carts/<name>', 'carts', lambda name: '')
+        with app.test_request_context('/api/carts/jane'):
+            self.assertEqual(
+                self.metrics.prefix('pages:3:role:admin:/api/carts/jane:{}'),
+                'pages:role:admin:/api/carts/<name>')
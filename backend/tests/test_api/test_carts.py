@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+
+import sqlalchemy as sa
+
+from api.app import db
+from api.models import Cart, Product
+from api import utilities
+from tests.base_test_case import BaseTestCase, TestConfig
+
+DATABASE = os.path.join(tempfile.gettempdir(), 'fabricare-test-carts.db')
+
+
+class FileConfig(TestConfig):
+    # Concurrent requests need their own connections to the same database
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + DATABASE
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}}
+
+
+class CartUpsertTests(BaseTestCase):
+    config = FileConfig
+
+    def setUp(self):
+        if os.path.exists(DATABASE):
+            os.remove(DATABASE)
+        super().setUp()
+        utilities.users(0)
+        utilities.artists(1)
+        utilities.products(1)
+        self.product_id = db.session.scalar(sa.select(Product.id))
+        self.headers = self.login('testuser')
+
+    def tearDown(self):
+        engine = db.engine
+        super().tearDown()
+        engine.dispose()
+        os.remove(DATABASE)
+
+    def items(self):
+        db.session.expire_all()
+        return db.session.scalars(sa.select(Cart)).all()
+
+    def add(self, size='M'):
+        return self.client.post(f'/api/products/carts/{self.product_id}',
+                                json={'size': size}, headers=self.headers)
+
+    def test_add_increments_the_same_item(self):
+        self.assertEqual(self.add().status_code, 201)
+        rv = self.add()
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(rv.json['quantity'], 2)
+        self.assertEqual(self.add('L').json['quantity'], 1)
+        self.assertEqual(sorted((item.size, item.quantity)
+                                for item in self.items()),
+                         [('L', 1), ('M', 2)])
+
+    def test_concurrent_additions_are_not_lost(self):
+        threads, additions = 8, 10
+        errors = []
+
+        def add():
+            client = self.app.test_client()
+            for _ in range(additions):
+                rv = client.post(f'/api/products/carts/{self.product_id}',
+                                 json={'size': 'M'}, headers=self.headers)
+                if rv.status_code != 201:
+                    errors.append(rv.status_code)
+
+        workers = [threading.Thread(target=add) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        items = self.items()
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].quantity, threads * additions)
+
+    def test_decrement_to_zero_deletes_the_item(self):
+        self.add()
+        self.add()
+        url = f'/api/me/carts/decr/{self.product_id}'
+        rv = self.client.put(url, json={}, headers=self.headers)
+        self.assertEqual(rv.json['quantity'], 1)
+        rv = self.client.put(url, json={}, headers=self.headers)
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(rv.json['quantity'], 0)
+        self.assertEqual(rv.json['total_price'], 0)
+        self.assertEqual(self.items(), [])
+        rv = self.client.put(url, json={}, headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_increment(self):
+        self.add()
+        rv = self.client.put(f'/api/me/carts/incr/{self.product_id}',
+                             json={'size': 'M'}, headers=self.headers)
+        self.assertEqual(rv.json['quantity'], 2)
+        price = db.session.get(Product, self.product_id).price
+        self.assertEqual(rv.json['total_price'], 2 * price)
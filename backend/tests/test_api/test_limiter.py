@@ -0,0 +1,62 @@
+import unittest
+
+from limits import parse
+from limits.storage import MemoryStorage
+
+from api import utilities
+from api.limiter import LocalBucketRateLimiter
+from tests.base_test_case import BaseTestCase, TestConfig
+
+
+class LimitedConfig(TestConfig):
+    RATELIMIT_ENABLED = True
+    RATELIMIT_STORAGE_URI = 'memory://'
+    RATELIMIT_BUDGETS = {
+        'catalog': {'anonymous': '3 per minute', 'default': '5 per minute',
+                    'admin': '8 per minute'},
+        'writes': {'anonymous': '2 per minute', 'default': '5 per minute',
+                   'admin': '8 per minute'},
+    }
+
+
+class LimiterTests(BaseTestCase):
+    config = LimitedConfig
+
+    def setUp(self):
+        super().setUp()
+        utilities.users(1)
+
+    def granted(self, count, method='get', url='/api/products', **kwargs):
+        statuses = [getattr(self.client, method)(url, **kwargs).status_code
+                    for _ in range(count)]
+        self.assertEqual(set(statuses[-1:]), {429})
+        return statuses.index(429)
+
+    def test_anonymous_catalog_budget(self):
+        self.assertEqual(self.granted(4), 3)
+
+    def test_anonymous_writes_budget(self):
+        self.assertEqual(self.granted(3, 'post', json={}), 2)
+
+    def test_budgets_follow_the_role(self):
+        client, admin = self.login('testuser'), self.login('testadmin')
+        self.assertEqual(self.granted(6, headers=client), 5)
+        self.assertEqual(self.granted(9, headers=admin), 8)
+
+    def test_users_are_counted_apart(self):
+        self.granted(6, headers=self.login('testuser'))
+        rv = self.client.get('/api/products', headers=self.login('testadmin'))
+        self.assertEqual(rv.status_code, 200)
+
+
+class LocalBucketTests(unittest.TestCase):
+    def test_local_grants_stay_within_the_limit(self):
+        limiter = LocalBucketRateLimiter(MemoryStorage(), share=0.5,
+                                         interval=60)
+        item = parse('20 per minute')
+        granted = [limiter.hit(item, 'client') for _ in range(30)]
+        self.assertEqual(granted.count(True), 20)
+        self.assertFalse(any(granted[20:]))
+        self.assertEqual(
+            limiter.get_window_stats(item, 'client').remaining, 0)
+        self.assertFalse(limiter.test(item, 'client'))
@@ -0,0 +1,81 @@
+import sqlalchemy as sa
+
+from api.app import db
+from api import utilities
+from api.models import Cart, User
+from tests.base_test_case import BaseTestCase
+
+
+class LoaderProfileTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # Random usernames may collide, which would roll the users back
+        utilities.fake.seed_instance(0)
+        utilities.users(30)
+        utilities.artists(5)
+        utilities.products(40)
+        utilities.orders(30)
+        utilities.carts(40)
+        self.headers = self.login('testadmin')
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.count)
+        super().tearDown()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def queries(self, url):
+        self.statements.clear()
+        rv = self.client.get(url, headers=self.headers)
+        self.assertEqual(rv.status_code, 200, rv.json)
+        return len(self.statements)
+
+    def assert_constant_queries(self, url):
+        self.queries(url)  # the first request also loads the token's user
+        self.assertEqual(self.queries(f'{url}?limit=5'),
+                         self.queries(f'{url}?limit=25'))
+
+    def test_products(self):
+        self.assert_constant_queries('/api/products')
+
+    def test_artists(self):
+        self.assert_constant_queries('/api/artists')
+
+    def test_users(self):
+        self.assert_constant_queries('/api/users')
+
+    def test_carts(self):
+        self.assert_constant_queries('/api/carts')
+
+    def test_my_carts(self):
+        self.headers = self.login('testuser')
+        for product_id in range(1, 31):
+            rv = self.client.post(f'/api/products/carts/{product_id}',
+                                  json={'size': 'M'}, headers=self.headers)
+            self.assertEqual(rv.status_code, 201)
+        self.assert_constant_queries('/api/me/carts')
+
+        # The total of the whole cart is an aggregate, only the items of
+        # the page are loaded
+        loaded = []
+
+        def load(cart, context):
+            loaded.append(cart.id)
+
+        sa.event.listen(Cart, 'load', load)
+        self.addCleanup(sa.event.remove, Cart, 'load', load)
+        db.session.expunge_all()
+        rv = self.client.get('/api/me/carts?limit=5', headers=self.headers)
+        self.assertEqual(rv.status_code, 200, rv.json)
+        # The page, and one more item telling whether another page follows
+        self.assertEqual(len(loaded), 6)
+        user_id = db.session.scalar(
+            sa.select(User.id).filter_by(username='testuser'))
+        self.assertEqual(rv.json['extra_data']['total_price'],
+                         Cart.total(user_id))
+
+    def test_orders(self):
+        self.assert_constant_queries('/api/orders')
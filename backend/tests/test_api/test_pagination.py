@@ -0,0 +1,88 @@
+import base64
+import json
+
+import sqlalchemy as sa
+
+from api.app import db
+from api.models import Product
+from api import utilities
+from api.schemas import PaginatedCollection, ProductSchema
+from tests.base_test_case import BaseTestCase
+
+
+def cursor(value):
+    data = json.dumps(value).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+class CursorTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.artists(1)
+        utilities.products(7)
+        # Products 2 to 5 share a timestamp, their ids break the tie
+        products = db.session.scalars(sa.select(Product)).all()
+        for product in products[1:5]:
+            product.timestamp = products[1].timestamp
+        db.session.commit()
+        self.expected = [product.id for product in sorted(
+            products, key=lambda p: (p.timestamp, p.id), reverse=True)]
+
+    def page(self, **args):
+        rv = self.client.get('/api/products', query_string=args)
+        self.assertEqual(rv.status_code, 200, rv.json)
+        return rv.json
+
+    def test_next_and_prev_cursors(self):
+        pages, page = [], self.page(limit=3)
+        self.assertNotIn('prev_cursor', page)
+        while True:
+            pages.append([product['id'] for product in page['data']])
+            if 'next_cursor' not in page:
+                break
+            page = self.page(limit=3, cursor=page['next_cursor'])
+        self.assertEqual(pages, [self.expected[:3], self.expected[3:6],
+                                 self.expected[6:]])
+        self.assertFalse(page['pagination']['has_more'])
+
+        for ids in reversed(pages[:-1]):
+            page = self.page(limit=3, cursor=page['prev_cursor'])
+            self.assertEqual([product['id'] for product in page['data']], ids)
+            self.assertTrue(page['pagination']['has_more'])
+        self.assertNotIn('prev_cursor', page)
+
+    def test_tampered_cursors(self):
+        timestamp = {'__datetime__': '2024-01-01T00:00:00'}
+        for tampered in ('not a cursor', cursor([0, 5]), cursor([0, [1]]),
+                         cursor([False, [timestamp, '1']]),
+                         cursor([False, [timestamp, True]]),
+                         cursor([False, [5, 1]]), cursor(['no', [timestamp, 1]]),
+                         cursor([False, [timestamp, 1, 2]])):
+            rv = self.client.get('/api/products',
+                                 query_string={'cursor': tampered})
+            self.assertEqual(rv.status_code, 400, tampered)
+        rv = self.client.get('/api/products', query_string={
+            'cursor': cursor([False, [timestamp, 1]])})
+        self.assertEqual(rv.status_code, 200)
+
+
+class FieldsTests(BaseTestCase):
+    def test_fields(self):
+        utilities.artists(1)
+        utilities.products(2)
+        for fields in ('id,title', 'title,id', ' title,id,id'):
+            rv = self.client.get('/api/products',
+                                 query_string={'fields': fields})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual([set(product) for product in rv.json['data']],
+                             [{'id', 'title'}] * 2)
+        rv = self.client.get('/api/products', query_string={'fields': 'nope'})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_schemas_are_shared_by_equivalent_instances(self):
+        schema = PaginatedCollection(
+            ProductSchema(many=True, only=('id', 'title')))
+        self.assertIs(PaginatedCollection(
+            ProductSchema(many=True, only=('title', 'id'))), schema)
+        self.assertIsNot(PaginatedCollection(ProductSchema(many=True)),
+                         schema)
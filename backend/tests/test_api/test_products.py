@@ -0,0 +1,170 @@
+from datetime import timedelta
+
+import sqlalchemy as sa
+
+from api import utilities
+from api.app import db
+from api.dates import naive_utcnow
+from api.models import Cart, Product, order_products
+from tests.base_test_case import BaseTestCase, CacheTestCase
+
+
+class BatchTests:
+    def setUp(self):
+        super().setUp()
+        utilities.artists(1)
+        utilities.products(3)
+
+    def assert_batch(self, rv, ids, missing):
+        self.assertEqual(rv.status_code, 200, rv.json)
+        self.assertEqual([product['id'] for product in rv.json['data']], ids)
+        self.assertEqual(rv.json['missing'], missing)
+
+    def test_get(self):
+        for _ in range(2):
+            rv = self.client.get('/api/products/batch?ids=3,1,99,3')
+            self.assert_batch(rv, [3, 1], [99])
+        self.assertEqual(rv.json['data'][0],
+                         self.client.get('/api/sales/3').json)
+
+    def test_post(self):
+        rv = self.client.post('/api/products/batch', json={'ids': [2, 7, 1]})
+        self.assert_batch(rv, [2, 1], [7])
+
+    def test_limits(self):
+        self.assertEqual(
+            self.client.get('/api/products/batch?ids=').status_code, 400)
+        rv = self.client.post('/api/products/batch',
+                              json={'ids': list(range(101))})
+        self.assertEqual(rv.status_code, 400)
+
+
+class ProductBatchTests(BatchTests, BaseTestCase):
+    pass
+
+
+class CachedProductBatchTests(BatchTests, CacheTestCase):
+    def test_get_reads_through_the_cache(self):
+        self.client.get('/api/sales/1')
+        self.client.get('/api/products/batch?ids=1,2')
+        hits = self.cache.stats()['prefixes']['entities:products:id']['hits']
+        self.assertEqual(hits, 1)
+
+
+class ExpirationTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.artists(1)
+        utilities.products(4)
+        self.products = db.session.scalars(
+            sa.select(Product).order_by(Product.id)).all()
+
+    def days_left(self, product):
+        return db.session.scalar(
+            sa.select(Product.days_left).where(Product.id == product.id))
+
+    def test_days_left(self):
+        soon, past = self.products[:2]
+        soon.expires_at = naive_utcnow() + timedelta(days=5, minutes=1)
+        past.expires_at = naive_utcnow() - timedelta(days=2)
+        db.session.commit()
+        self.assertEqual((soon.days_left, self.days_left(soon)), (5, 5))
+        self.assertEqual((past.days_left, self.days_left(past)), (0, 0))
+
+        soon.days_left = 0
+        db.session.commit()
+        self.assertTrue(soon.expire)
+        self.assertEqual(self.days_left(soon), 0)
+
+    def test_expire_due(self):
+        for product in self.products[:3]:
+            product.expires_at = naive_utcnow() - timedelta(minutes=1)
+        self.products[3].expires_at = naive_utcnow() + timedelta(days=1)
+        db.session.commit()
+        ids = [product.id for product in self.products]
+        self.assertEqual(Product.expire_due(chunk_size=2), ids[:3])
+        self.assertEqual(Product.expire_due(chunk_size=2), [])
+        db.session.expire_all()
+        self.assertEqual([product.expire for product in self.products],
+                         [True, True, True, False])
+
+    def test_backfill_expires_at(self):
+        db.session.execute(sa.update(Product).values(expires_at=None))
+        db.session.commit()
+        self.assertEqual(Product.backfill_expires_at(chunk_size=3), 4)
+        db.session.expire_all()
+        for product in self.products:
+            self.assertEqual(product.expires_at, product.timestamp +
+                             timedelta(days=product.deadline))
+
+    def test_active_filter(self):
+        self.products[0].expires_at = naive_utcnow() - timedelta(minutes=1)
+        db.session.commit()
+        Product.expire_due()
+
+        def ids(**args):
+            rv = self.client.get('/api/products', query_string=args)
+            return sorted(product['id'] for product in rv.json['data'])
+
+        self.assertEqual(ids(active='true'),
+                         [product.id for product in self.products[1:]])
+        self.assertEqual(ids(active='false'), [self.products[0].id])
+        self.assertEqual(len(ids()), 4)
+
+
+class BulkTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['BULK_CHUNK_SIZE'] = 2
+        utilities.users(2)
+        utilities.artists(1)
+        utilities.products(5)
+        utilities.orders(3)
+        utilities.carts(5)
+        products = db.session.scalars(
+            sa.select(Product).order_by(Product.id)).all()
+        for product in products:
+            product.color = 'red' if product.id % 2 else 'blue'
+        db.session.commit()
+        self.red = [product.id for product in products if product.id % 2]
+        Cart.add(1, self.red[0], 'XXL')
+        db.session.commit()
+        self.headers = self.login('testadmin')
+
+    def product_ids(self, *where):
+        return db.session.scalars(
+            sa.select(Product.id).where(*where).order_by(Product.id)).all()
+
+    def test_expire(self):
+        rv = self.client.put('/api/products-all?color=red',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 204)
+        self.assertEqual(self.product_ids(Product.expire.is_(True)), self.red)
+        # Already expired products still match
+        rv = self.client.put('/api/products-all?color=red',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 204)
+        rv = self.client.put('/api/products-all?color=green',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_delete(self):
+        rv = self.client.delete('/api/products-all?color=red',
+                                headers=self.headers)
+        self.assertEqual(rv.status_code, 204)
+        self.assertEqual(self.product_ids(Product.color == 'red'), [])
+        self.assertEqual(len(self.product_ids()), 5 - len(self.red))
+        for table, column in ((Cart.__table__, 'product_id'),
+                              (order_products, 'product_id')):
+            self.assertEqual(db.session.scalar(
+                sa.select(sa.func.count()).select_from(table)
+                .where(table.c[column].in_(self.red))), 0)
+        rv = self.client.delete('/api/products-all?color=red',
+                                headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_clients_are_denied(self):
+        rv = self.client.delete('/api/products-all',
+                                headers=self.login('testuser'))
+        self.assertEqual(rv.status_code, 403)
+        self.assertEqual(len(self.product_ids()), 5)
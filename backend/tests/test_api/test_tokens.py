@@ -0,0 +1,176 @@
+from datetime import timedelta
+from unittest import mock
+
+import sqlalchemy as sa
+
+from api import utilities
+from api.app import db
+from api.dates import naive_utcnow
+from api.models import Token, User
+from api.redis import DENY_LIST_KEY
+from api.tokens import clean_tokens
+from tests.base_test_case import BaseTestCase, CacheTestCase, TestConfig
+
+
+def delete_user(username):
+    """Delete a user's row alone, as another worker or a script could,
+    leaving its tokens to be found."""
+    db.session.execute(sa.delete(User.__table__)
+                       .where(User.username == username))
+    db.session.commit()
+
+
+class TokenCleanTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.users(0)
+
+    def add_tokens(self, count, refresh_expiration):
+        for _ in range(count):
+            token = Token(user_id=1)
+            token.generate()
+            token.refresh_expiration = refresh_expiration
+            db.session.add(token)
+        db.session.commit()
+
+    def test_clean(self):
+        now = naive_utcnow()
+        self.add_tokens(5, now - timedelta(days=2))
+        self.add_tokens(2, now - timedelta(hours=1))
+        self.add_tokens(1, now + timedelta(days=1))
+        self.assertEqual(Token.clean(chunk_size=2), 5)
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(Token)), 3)
+        self.assertEqual(Token.clean(chunk_size=2), 0)
+
+    def test_clean_tokens_task(self):
+        self.add_tokens(3, naive_utcnow() - timedelta(days=2))
+        self.app.config['BULK_CHUNK_SIZE'] = 1
+        clean_tokens()
+        self.assertEqual(db.session.scalar(
+            sa.select(sa.func.count()).select_from(Token)), 0)
+
+
+class TokenCacheTests(CacheTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.users(0)
+
+    def me(self, headers):
+        return self.client.get('/api/me', headers=headers).status_code
+
+    def cached(self, headers):
+        access_token = Token.decode_jwt(headers['Authorization'].split()[1])
+        return self.cache.verified_token(access_token) is not None
+
+    def test_tokens_replaced_by_a_new_login_are_revoked(self):
+        old = self.login('testuser')
+        self.assertEqual(self.me(old), 200)
+        self.assertTrue(self.cached(old))
+        new = self.login('testuser')
+        self.assertFalse(self.cached(old))
+        self.assertEqual(self.me(old), 401)
+        self.assertEqual(self.me(new), 200)
+
+    def test_revoked_tokens(self):
+        headers = self.login('testuser')
+        self.assertEqual(self.me(headers), 200)
+        rv = self.client.delete('/api/tokens', headers=headers)
+        self.assertEqual(rv.status_code, 204)
+        self.assertEqual(self.me(headers), 401)
+
+
+    def test_tokens_are_not_cached_while_unsubscribed(self):
+        headers = self.login('testuser')
+        self.assertEqual(self.me(headers), 200)
+        self.assertTrue(self.cached(headers))
+        with mock.patch.object(self.redis, 'pubsub',
+                               side_effect=ConnectionError):
+            listener = self.cache._listener
+            self.cache._on_listener_error(ConnectionError(), None, listener)
+            self.assertFalse(self.cached(headers))
+            self.assertEqual(self.me(headers), 200)
+            self.assertFalse(self.cached(headers))
+            # Revoked by another worker, whose broadcast this one misses
+            db.session.execute(sa.delete(Token.__table__))
+            db.session.commit()
+            self.assertEqual(self.me(headers), 401)
+
+    def test_tokens_of_deleted_users(self):
+        headers = self.login('testuser')
+        self.assertEqual(self.me(headers), 200)
+        self.assertTrue(self.cached(headers))
+        delete_user('testuser')
+        self.assertEqual(self.me(headers), 401)
+
+
+class StatelessConfig(TestConfig):
+    STATELESS_ACCESS_TOKENS = True
+
+
+class StatelessTokenTests(CacheTestCase):
+    config = StatelessConfig
+
+    def setUp(self):
+        super().setUp()
+        utilities.users(0)
+        self.statements = []
+        sa.event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        sa.event.remove(db.engine, 'before_cursor_execute', self.count)
+        super().tearDown()
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def me(self, headers):
+        return self.client.get('/api/me', headers=headers).status_code
+
+    def denied(self, headers):
+        access_token = Token.decode_jwt(headers['Authorization'].split()[1])
+        return self.redis.ttl(DENY_LIST_KEY.format(access_token))
+
+    def test_requests_skip_the_tokens_table(self):
+        headers = self.login('testuser')
+        self.statements.clear()
+        self.assertEqual(self.me(headers), 200)
+        self.assertEqual([s for s in self.statements if 'tokens' in s], [])
+
+    def test_revoked_tokens_are_denied(self):
+        headers = self.login('testuser')
+        self.assertEqual(self.me(headers), 200)
+        self.client.delete('/api/tokens', headers=headers)
+        self.assertGreater(self.denied(headers), 0)
+        self.assertLessEqual(self.denied(headers),
+                             self.app.config['ACCESS_TOKEN_MINUTES'] * 60)
+        self.assertEqual(self.me(headers), 401)
+
+    def test_tokens_replaced_by_a_new_login_are_denied(self):
+        old = self.login('testuser')
+        new = self.login('testuser')
+        self.assertGreater(self.denied(old), 0)
+        self.assertEqual(self.me(old), 401)
+        self.assertEqual(self.me(new), 200)
+
+    def test_tokens_table_is_read_without_redis(self):
+        revoked = self.login('testuser')
+        self.client.delete('/api/tokens', headers=revoked)
+        replaced = self.login('testadmin')
+        valid = self.login('testadmin')
+        self.statements.clear()
+        with mock.patch.object(self.redis, 'get',
+                               side_effect=ConnectionError):
+            self.assertEqual(self.me(valid), 200)
+            self.assertTrue([s for s in self.statements if 'tokens' in s])
+            self.assertEqual(self.me(revoked), 401)
+            self.assertEqual(self.me(replaced), 401)
+
+    def test_tokens_of_deleted_users(self):
+        headers = self.login('testuser')
+        delete_user('testuser')
+        self.assertEqual(self.me(headers), 401)
+
+    def test_expired_tokens(self):
+        self.app.config['ACCESS_TOKEN_MINUTES'] = -1
+        self.assertEqual(self.me(self.login('testuser')), 401)
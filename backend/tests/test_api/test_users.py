@@ -0,0 +1,120 @@
+import threading
+import time
+from unittest import mock
+
+from werkzeug.security import generate_password_hash
+
+from api import utilities
+from api.app import db, scheduler, activity
+from api.dates import naive_utcnow
+from api.models import User
+from api.passwords import _run, hash_version
+from api.uniqueness import unique_violations
+from tests.base_test_case import BaseTestCase
+
+
+class ActivityTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.users(0)
+        activity.drain()  # the times buffered by the other tests' requests
+
+    def test_buffer_is_saved_at_worker_exit(self):
+        self.app.testing = False
+        self.app.config['ACTIVITY_FLUSH_INTERVAL'] = 60
+        scheduler._pid = None
+        with mock.patch('api.tasks.threading.Thread'), \
+                mock.patch('api.tasks.atexit.register') as register:
+            scheduler._start()
+        self.app.testing = True
+        exits = [call.args for call in register.call_args_list
+                 if call.args[2] == 'save_activity']
+        self.assertEqual(len(exits), 1)
+
+        seen = naive_utcnow().replace(microsecond=0)
+        activity.touch(1, seen)
+        run_at_exit, *args = exits[0]
+        run_at_exit(*args)
+        self.assertEqual(len(activity), 0)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, 1).last_seen, seen)
+
+
+class PasswordTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        utilities.users(0)
+
+    def test_legacy_hashes_are_upgraded_on_login(self):
+        user = db.session.get(User, 1)
+        user.password_hash = generate_password_hash(
+            '123456', method='pbkdf2:sha256:1000')
+        db.session.commit()
+        self.login(user.username)
+        db.session.expire_all()
+        self.assertTrue(db.session.get(User, 1).password_hash.startswith(
+            hash_version(self.app.config['PASSWORD_HASH_METHOD']) + '$'))
+        self.login(user.username)
+
+    def test_concurrent_hashes_are_bounded(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 2
+        running, peak = [], []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+        def request():
+            with self.app.app_context():
+                _run(work)
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 6)
+        self.assertEqual(max(peak), 2)
+
+
+class UniquenessTests(BaseTestCase):
+    def test_duplicate_values_do_not_hide_other_fields(self):
+        # Emails are not unique, the rows sharing one are matched first
+        db.session.add_all([
+            User(first_name='first', last_name='user', username=username,
+                 email='shared@example.com')
+            for username in ('first', 'second')])
+        db.session.commit()
+        utilities.users(0)
+        errors = unique_violations(User, {'email': 'shared@example.com',
+                                          'username': 'testuser'})
+        self.assertEqual(set(errors), {'username', 'email'})
+
+    def register(self, username, email):
+        return self.client.post('/api/users', json={
+            'first_name': 'new', 'last_name': 'user', 'username': username,
+            'email': email, 'password': 'secret12#'})
+
+    def assert_taken(self, precheck):
+        self.app.config['UNIQUE_PRECHECK'] = precheck
+        utilities.users(0)
+        rv = self.register('newuser', 'non-admin@gmail.com')
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('email', rv.json['errors']['json'])
+        rv = self.register('testuser', 'new@example.com')
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('username', rv.json['errors']['json'])
+        self.assertEqual(self.register('newuser', 'new@example.com')
+                         .status_code, 201)
+
+    def test_taken_values_with_precheck(self):
+        self.assert_taken(True)
+
+    def test_taken_values_without_precheck(self):
+        # Emails have no unique constraint and are always probed
+        self.assert_taken(False)